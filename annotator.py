@@ -21,7 +21,7 @@ import streamlit as st
 from config import default as config
 import util
 import util.streamlit as stutil
-from util.video import TimePoint, TimeFrame
+from util.video import TimePoint, TimeFrame, get_video_registry
 
 
 st.set_page_config(page_title=config.TITLE, layout="wide")
@@ -72,8 +72,7 @@ if mode == 'add annotations':
     with st.container(border=True):
         tf = stutil.display_capture_boundaries()
         if not add_settings['hide_boundaries']:
-            stutil.display_left_boundary(tf)
-            stutil.display_right_boundary(tf)
+            stutil.display_boundaries(tf)
 
     # A button to loop the video for the currently selected timeframe
     if len(st.session_state.annotation.timeframe) > 0:
@@ -160,7 +159,19 @@ if mode == 'show annotations':
             'Export annotations in ELAN format',
             on_click=util.annotation.export_annotations)
         if exported:
-            st.info(f'Annotations were exported to {st.session_state.io["elan"]}')
+            st.info(f'Annotations were exported to {st.session_state.io["elan"]}'
+                    f' and {st.session_state.io["eaf"]}')
+        exported_parquet = st.button(
+            'Export annotations in Parquet format',
+            on_click=util.annotation.export_annotations_parquet)
+        if exported_parquet:
+            st.info(f'Annotations were exported to {st.session_state.io["parquet"]}')
+        compacted = st.button(
+            'Compact annotations file',
+            on_click=util.annotation.compact_annotations)
+        if compacted:
+            st.info(f'Annotations file was compacted, the old file was kept as'
+                    f' {st.session_state.store.backup_path}')
     stutil.display_messages()
     stutil.display_annotations(list_settings)
 
@@ -251,4 +262,12 @@ if mode == 'dev':
     elif dev == 'Show image cache':
         with st.container(border=True):
             st.markdown('**Image cash**')
-            st.write(' '.join(str(tp) for tp in sorted(st.session_state.cache.data)))
+            st.write(st.session_state.cache.stats())
+            if video.disk_cache is not None:
+                st.markdown('**Disk cache**')
+                st.write(video.disk_cache.stats())
+            st.markdown('**Contact sheets**')
+            st.write(video.contact_sheets.sheets.stats())
+            st.markdown('**Sessions per video**')
+            st.write(get_video_registry().stats())
+            st.write(' '.join(str(tp) for tp in sorted(st.session_state.cache.keys())))
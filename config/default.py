@@ -16,6 +16,11 @@ TITLE = "Action Annotator"
 DEFAULT_VIDEO_WIDTH = 50    # video width in percentage of total width
 DEFAULT_IMAGE_WIDTH = 100   # image width in pixels
 
+# Frames shown in the tool are stored as thumbnails that are scaled down to the
+# image width and encoded, the format can be '.jpg' or '.webp'.
+THUMBNAIL_FORMAT = '.jpg'
+THUMBNAIL_QUALITY = 85
+
 # Number of frames printed from the context window. The only numbers that make
 # sense here are from 3 to probably 6.
 CONTEXT_SIZE = 5
@@ -23,6 +28,90 @@ CONTEXT_SIZE = 5
 # Spacing between frames in the context window, in milliseconds.
 CONTEXT_STEP = 100
 
+# When extracting a window of frames we seek once and then decode sequentially,
+# but if the next frame is more than this many milliseconds ahead we seek again
+# (if we know where the keyframes are we seek again if that skips at least this
+# many milliseconds of decoding).
+MAX_DECODE_GAP = 2000
+
+# Maximum number of decoders used to extract frames in parallel, each decoder has
+# its own handle on the video file.
+DECODER_POOL_SIZE = 4
+
+# Number of seconds to wait for frames that need to be extracted from the video,
+# frames that take longer are shown as a preview from the filmstrip and they are
+# added to the image cache when they come in.
+FRAME_DEADLINE = 2
+
+# Memory budget for the image cache in megabytes, when the cache is full the least
+# recently used images are evicted. A thumbnail takes up a few kilobytes.
+IMAGE_CACHE_SIZE = 100
+
+# Thumbnails can be taken from a small proxy of the video where every frame is a
+# keyframe, which is much faster than taking them from the video itself. The proxy
+# is created in the background the first time the video is opened and stored in
+# the data directory, the width is in pixels.
+USE_PROXY = False
+PROXY_WIDTH = 320
+
+# A filmstrip with a thumbnail every FILMSTRIP_STEP milliseconds over the whole
+# video is created in the background and used for instant previews when seeking
+# and in the timeline, the width of the thumbnails is in pixels.
+FILMSTRIP_STEP = 1000
+FILMSTRIP_WIDTH = 100
+
+# Motion energy is computed for all frames of the video in the background, using
+# frames scaled down to MOTION_WIDTH pixels. Points where motion starts or stops
+# that are at most MOTION_SNAP_WINDOW milliseconds from the start and end of the
+# timeframe are offered as snap points, with at most MOTION_SNAP_POINTS for each.
+MOTION_WIDTH = 64
+MOTION_SNAP_WINDOW = 1000
+MOTION_SNAP_POINTS = 3
+
+# Thumbnails are also cached on disk so they are shared by all sessions and survive
+# restarts. The cache is stored in two pack files that start with the path below,
+# the size is in megabytes and setting it to 0 switches off the disk cache.
+DISK_CACHE_PATH = 'data/frames'
+DISK_CACHE_SIZE = 1000
+
+# While the annotator is busy, frames around where the annotator is likely to go
+# next are loaded in the background. This includes frames this many milliseconds
+# before and after the start and end of the current timeframe, use 0 to switch off
+# prefetching.
+PREFETCH_DISTANCE = 1000
+
+# When an annotation is selected in the timeline a contact sheet with frames from
+# the annotation is shown, with at most CONTACT_SHEET_SIZE frames that are spaced
+# CONTACT_SHEET_STEP milliseconds apart. Contact sheets are made in the background
+# and cached, the cache size is in megabytes.
+CONTACT_SHEET_SIZE = 10
+CONTACT_SHEET_STEP = 500
+CONTACT_SHEET_CACHE_SIZE = 20
+
+# The annotations file is a log where records are only ever added, so annotations
+# that were removed or replaced are still in there. When the file is loaded and
+# more than COMPACTION_RATIO of its records are not needed anymore the file is
+# replaced by a snapshot of the annotations and the object pool, but only if the
+# file has at least COMPACTION_MIN_RECORDS records. The old file is kept as a
+# backup next to the new one.
+COMPACTION_RATIO = 0.5
+COMPACTION_MIN_RECORDS = 1000
+
+# Annotations are stored in data/VIDEO_FILE.json unless ANNOTATION_STORE is set
+# to 'sqlite', in which case the annotations of all videos are stored in the SQLite
+# database at ANNOTATION_DATABASE. The annotations file of a video is imported into
+# the database the first time the video is opened.
+ANNOTATION_STORE = 'jsonl'
+ANNOTATION_DATABASE = 'data/annotations.db'
+
+# Records for the annotations file are written by a background writer that is
+# shared by all sessions on the same video. Records that come in within
+# ANNOTATION_WRITE_WINDOW seconds of each other are written together. With an
+# ANNOTATION_FSYNC of 'batch' each write is synced to disk before saving an
+# annotation is confirmed, with 'never' syncing is left to the operating system.
+ANNOTATION_WRITE_WINDOW = 0.01
+ANNOTATION_FSYNC = 'batch'
+
 # This determines how many seconds to the left and right the fine-tuning slider
 # includes.
 FINE_TUNING_WINDOW = 0.5
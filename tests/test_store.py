@@ -0,0 +1,66 @@
+"""
+
+Tests for the annotations file store.
+
+$ python -m pytest tests
+
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The configuration loads the task configuration from the command line, so set it
+# up like it is when running the annotator
+sys.argv = ['annotator.py', 'VIDEO_FILE.mp4', os.path.join(ROOT, 'config', 'actions_dpip.py')]
+
+from util.store import JsonlStore, LogWriter
+
+
+class FailingWriter(LogWriter):
+
+    """Writer that fails to write the first batch."""
+
+    def __init__(self, path: str):
+        self.failed = False
+        super().__init__(path, window=0, fsync='none')
+
+    def write_batch(self, batch: list) -> list:
+        if not self.failed:
+            self.failed = True
+            raise OSError('disk full')
+        return super().write_batch(batch)
+
+
+def annotation(identifier):
+    return {'identifier': identifier, 'task': 'DPIP-Actions', 'tier': 'ACTION1',
+            'start': 1000, 'end': 2000, 'predicate': None,
+            'arguments': {}, 'properties': {}}
+
+
+def test_flush_accounts_for_writes_after_a_failed_write(tmp_path):
+    path = str(tmp_path / 'video.json')
+    store = JsonlStore(path)
+    store.read()
+    store.writer = FailingWriter(path)
+    store.append([annotation('a0001')], wait=False)
+    # Make sure the first record is in a batch of its own
+    assert store.pending[0][1].exception() is not None
+    store.append([annotation('a0002')], wait=False)
+    with pytest.raises(OSError):
+        store.flush()
+    assert store.pending == []
+    assert store.offset == os.path.getsize(path)
+    assert store.records == 1
+    # Records from another session are read, ours are not read again
+    with open(path, 'a') as fh:
+        fh.write(json.dumps(annotation('a0003')) + '\n')
+    records, full = store.read()
+    assert not full
+    assert [r['identifier'] for r in records] == ['a0003']
+    assert store.records == 2
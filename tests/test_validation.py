@@ -0,0 +1,80 @@
+"""
+
+Tests for the validators, using the DPIP action configuration.
+
+$ python -m pytest tests
+
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The configuration loads the task configuration from the command line, so set it
+# up like it is when running the annotator
+sys.argv = ['annotator.py', 'VIDEO_FILE.mp4', os.path.join(ROOT, 'config', 'actions_dpip.py')]
+
+from util import process_arguments
+from util.validation import get_validator
+
+
+def dpip_validator():
+    return get_validator()
+
+
+def in_play(obj_type):
+    return {'LargeRedBlock1', 'SmallBlueBlock2'} if obj_type == 'blocks' else set()
+
+
+def annotation(predicate, arguments):
+    return {'task': 'DPIP-Actions', 'tier': 'ACTION1', 'start': 1000, 'end': 2000,
+            'predicate': predicate, 'arguments': arguments, 'properties': {}}
+
+
+def test_put_with_relation_and_location():
+    validator = dpip_validator()
+    arguments = process_arguments({
+        'Object': ['LargeRedBlock1'], 'Location': ['on', 'Base', '']})
+    assert arguments['Location'] == 'on(Base)'
+    assert validator.check(annotation('PUT', arguments), in_play) == []
+
+
+def test_put_with_block_as_location():
+    validator = dpip_validator()
+    arguments = {'Object': 'LargeRedBlock1', 'Location': 'on(SmallBlueBlock2)'}
+    assert validator.check(annotation('PUT', arguments), in_play) == []
+
+
+def test_put_with_free_text_location():
+    validator = dpip_validator()
+    arguments = process_arguments({
+        'Object': ['LargeRedBlock1'], 'Location': [None, None, 'next to the tower']})
+    assert validator.check(annotation('PUT', arguments), in_play) == []
+
+
+def test_move_with_all_locations():
+    validator = dpip_validator()
+    arguments = {'Object': 'SmallBlueBlock2', 'Source': 'on(Base)',
+                 'Destination': 'above(LargeRedBlock1)'}
+    assert validator.check(annotation('MOVE', arguments), in_play) == []
+
+
+def test_object_not_in_play():
+    validator = dpip_validator()
+    arguments = {'Object': 'LargeGreenBlock3', 'Location': 'on(Base)'}
+    errors = validator.check(annotation('PUT', arguments), in_play)
+    assert errors == ['WARNING: "LargeGreenBlock3" is not a valid value for argument "Object"']
+
+
+def test_missing_required_argument():
+    validator = dpip_validator()
+    errors = validator.check(annotation('TURN', {'Object': None}), in_play)
+    assert errors == ['WARNING: required argument "Object" is not specified']
+
+
+def test_unknown_predicate():
+    validator = dpip_validator()
+    errors = validator.check(annotation('JUMP', {}), in_play)
+    assert errors == ['WARNING: "JUMP" is not a known predicate']
@@ -9,19 +9,21 @@ import sys
 from datetime import datetime, time
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from config import default as config
-from util.video import TimePoint, TimeFrame
+from util.video import TimePoint, TimeFrame, timestamps
 
 
 def get_timeline(annotations: list) -> list:
     basetime = '1999-01-01T00'
+    starts = timestamps([annotation.start for annotation in annotations], short=True)
     items = []
-    for n, annotation in enumerate(annotations):
+    for annotation, start in zip(annotations, starts):
         items.append({
             "id": annotation.identifier, "content": annotation.name,
             "group": annotation.tier,
-            "start": f'{basetime}:{annotation.start_as_string()}',
+            "start": f'{basetime}:{start}',
             "annotation": annotation.as_json()})
     return items
 
@@ -51,15 +53,28 @@ def create_timeframe_from_slider_inputs(t1: time, t2: time) -> TimeFrame:
 def timestamp():
     return datetime.now().strftime('%Y%m%d:%H%M%S')
 
+def log_file():
+    """Returns the log file of the session, or None when we are not running for a
+    session, which is the case in background threads that are shared by sessions.
+    Messages from those threads are only printed."""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.io['log']
+
 def log(text: str):
     # TODO: refactor these log messages
-    with open(st.session_state.io['log'], 'a') as fh:
+    path = log_file()
+    if path is None:
+        print(f'INFO  {timestamp()}\t{text}')
+        return
+    with open(path, 'a') as fh:
         fh.write(f'INFO  {timestamp()}\t{text}\n')
 
 def debug(header: str, body: str = ''):
-    if st.session_state.debug:
+    path = log_file()
+    if path is not None and st.session_state.debug:
         ts = timestamp()
-        with open(st.session_state.io['log'], 'a') as fh:
+        with open(path, 'a') as fh:
             fh.write(f'DEBUG {ts}\t{header}\n')
             print(f'DEBUG {ts}\t{header}')
             if body:
@@ -69,24 +84,22 @@ def debug(header: str, body: str = ''):
 
 def error(header: str, body: str = ''):
     ts = timestamp()
-    with open(st.session_state.io['log'], 'a') as fh:
-        fh.write(f'ERROR {ts}\t{header}\n')
-        print(f'ERROR {ts}\t{header}')
-        if body:
-            print(body)
-            for line in body.split('\n'):
-                fh.write(f'ERROR {line}\n')
+    print(f'ERROR {ts}\t{header}')
+    if body:
+        print(body)
+    path = log_file()
+    if path is not None:
+        with open(path, 'a') as fh:
+            fh.write(f'ERROR {ts}\t{header}\n')
+            if body:
+                for line in body.split('\n'):
+                    fh.write(f'ERROR {line}\n')
 
 def create_label(text: str, size='normalsize'):
     """Return formatted text that can be used as a label of a particular size,
     for sizes use the ones defined by LaTeX (small, large, Large, etcetera)."""
     return r"$\textsf{" + f'\\{size} {text}' + "}$"
 
-def current_timeframes(task: str) -> list:
-    """Returns all <name, timeframe> pairs of the current annotations in the task."""
-    annos = st.session_state.annotations
-    return [(anno.name, anno.timeframe) for anno in annos if anno.task == task]
-
 def process_arguments(args: dict):
     """Pull the relevant values out of the return values from the widgets."""
     # TODO: this now makes way too many assumptions, the config settings should
@@ -1,6 +1,4 @@
-import os
-import json
-import pathlib
+import bisect
 import functools
 from copy import deepcopy
 
@@ -8,37 +6,115 @@ import streamlit as st
 
 from config import default as config
 from util.video import TimePoint, TimeFrame
+from util.intervals import IntervalTree
+from util.search import SearchIndex
+from util.export import export_parquet
+from util.validation import get_validator
 import util
+import util.eaf
 
 
 def load_annotations():
-    filename = st.session_state.io['json']
-    if not os.path.isfile(filename):
-        pathlib.Path(filename).touch()
-    video_path = st.session_state.video.path
-    with open(filename) as fh:
-        raw_annotations = [json.loads(line) for line in fh]
-        annotations = []
-        removed_annotations = []
-        for raw_annotation in raw_annotations:
-            try:
-                if 'add-object' in raw_annotation:
-                    obj_type, obj = raw_annotation['add-object'][:2]
-                    st.session_state.pool.put_object_in_play(obj_type, obj)
-                elif 'remove-object' in raw_annotation:
-                    obj_type, obj = raw_annotation['remove-object'][:2]
-                    st.session_state.pool.remove_object_from_play(obj_type, obj)
-                elif 'remove-annotation' in raw_annotation:
-                    removed_annotations.append(raw_annotation['remove-annotation'])
-                else:
-                    annotation = Annotation().import_fields(raw_annotation)
-                    annotations.append(annotation)
-            except Exception:
-                st.session_state.errors.append(f'Error loading {raw_annotation}')
-                util.error(f'Error loading {raw_annotation}')
-        annotations = [a for a in annotations if a.identifier not in removed_annotations]
-        st.session_state.annotations = annotations
-        util.log(f'Loaded annotations from {filename}')
+    """Load the annotations and the state of the object pool from the annotations
+    file. The first time around this reads the whole file, after that it only reads
+    the records that were added since the last load and applies those to what we
+    already have. If the file was truncated or replaced then we start over. When
+    the file has too many records that do not matter anymore it is compacted."""
+    read_annotations()
+    if dead_record_ratio() > config.COMPACTION_RATIO:
+        compact_annotations(threshold=config.COMPACTION_RATIO)
+
+
+def read_annotations():
+    store = st.session_state.store
+    records, full = store.read()
+    if full:
+        st.session_state.annotations = AnnotationRegistry()
+        st.session_state.pool = ObjectPool.from_config()
+    changed = apply_records(records)
+    st.session_state.video.contact_sheets.schedule(changed)
+    util.log(f'Loaded {len(records)} records from {store.path}')
+
+
+def dead_record_ratio() -> float:
+    """Return the ratio of records in the annotations file that are not needed for
+    the current annotations, which are removed or replaced annotations and object
+    pool records. Files with fewer than COMPACTION_MIN_RECORDS records are never
+    worth compacting and get 0."""
+    records = st.session_state.store.records
+    if records < config.COMPACTION_MIN_RECORDS:
+        return 0
+    return max(0, records - len(st.session_state.annotations)) / records
+
+
+def compact_annotations(threshold: float = None) -> bool:
+    """Replace the annotations file with a snapshot of the current annotations and
+    the object pool. The snapshot is one record at the start of the new file and
+    records saved after this are added after the snapshot. The file is locked while
+    we catch up with records that other sessions may have added, so nothing gets
+    lost, and the old file is kept as a backup. With a threshold the file is only
+    compacted if the ratio of dead records is still above it after catching up,
+    because another session may have just compacted it. Returns True if the file
+    was compacted."""
+    store = st.session_state.store
+    with store.locked():
+        read_annotations()
+        if threshold is not None and dead_record_ratio() <= threshold:
+            return False
+        records = store.records
+        snapshot = {
+            'annotations': [a.as_json() for a in st.session_state.annotations],
+            'pool': st.session_state.pool.as_snapshot(),
+            'max_identifier': st.session_state.annotations.max_identifier }
+        store.replace([{'snapshot': snapshot}])
+    util.log(f'Compacted {store.path} from {records} records to'
+             f' {len(snapshot["annotations"])} annotations, backup in {store.backup_path}')
+    return True
+
+
+def apply_records(records: list):
+    """Apply records from the annotations file to the annotations and the object
+    pool. Records are applied in order and an annotation replaces an earlier
+    annotation with the same identifier, so applying records that were already
+    applied does not change anything. Returns the annotations that were added or
+    replaced and that were not removed again."""
+    annotations = st.session_state.annotations
+    pool = st.session_state.pool
+    changed = {}
+    for record in records:
+        try:
+            if 'snapshot' in record:
+                # A snapshot has everything from before it so it replaces what we
+                # have, it is normally the first record in the file anyway
+                annotations = st.session_state.annotations = AnnotationRegistry()
+                pool = st.session_state.pool = ObjectPool.from_snapshot(
+                    record['snapshot']['pool'])
+                changed = {}
+                for fields in record['snapshot']['annotations']:
+                    annotation = Annotation().import_fields(fields)
+                    annotations.add(annotation)
+                    changed[annotation.identifier] = annotation
+                # Identifiers of annotations removed before the snapshot are not
+                # in the snapshot annotations
+                annotations.max_identifier = max(
+                    annotations.max_identifier, record['snapshot'].get('max_identifier', 0))
+            elif 'add-object' in record:
+                obj_type, obj = record['add-object'][:2]
+                pool.put_object_in_play(obj_type, obj)
+            elif 'remove-object' in record:
+                obj_type, obj = record['remove-object'][:2]
+                pool.remove_object_from_play(obj_type, obj)
+            elif 'remove-annotation' in record:
+                annotations.remove(record['remove-annotation'])
+                changed.pop(record['remove-annotation'], None)
+            else:
+                annotation = Annotation().import_fields(record)
+                annotations.add(annotation)
+                changed[annotation.identifier] = annotation
+        except Exception:
+            st.session_state.errors.append(f'Error loading {record}')
+            util.error(f'Error loading {record}')
+    return list(changed.values())
 
 
 def export_annotations():
@@ -46,9 +122,16 @@ def export_annotations():
     with open(elan_file, 'w') as fh:
         for annotation in st.session_state.annotations:
             fh.write(annotation.as_elan() + '\n')
+    util.eaf.write_eaf(
+        st.session_state.annotations, st.session_state.io['eaf'],
+        media_path=st.session_state.io['video_path'])
             
+def export_annotations_parquet():
+    st.session_state.store.flush()
+    export_parquet([st.session_state.io['json']], st.session_state.io['parquet'])
+
 def annotation_identifiers() -> list:
-    return [annotation.identifier for annotation in st.session_state.annotations]
+    return st.session_state.annotations.identifiers()
 
 
 def overlap(tf1: 'TimeFrame', tf2: 'TimeFrame'):
@@ -61,8 +144,172 @@ def overlap(tf1: 'TimeFrame', tf2: 'TimeFrame'):
     return True
 
 
+class AnnotationRegistry:
+
+    """The saved annotations, keyed on identifier. Besides the dictionary from
+    identifiers to annotations the registry keeps the highest identifier number
+    handed out so far, a list of the annotations sorted on start time that is kept
+    sorted with bisection, the interval index and the search index. Iterating over
+    the registry gives the annotations in start order.
+
+    The dictionary is in the order in which annotations were added, so the last
+    annotation in there is the one that was saved last. An annotation that replaces
+    an earlier one with the same identifier goes to the end."""
+
+    def __init__(self, annotations: list = ()):
+        self.annotations = {}
+        self.ordered = []
+        self.sort_keys = []
+        self.max_identifier = 0
+        self.index = AnnotationIndex()
+        self.search_index = SearchIndex()
+        for annotation in annotations:
+            self.add(annotation)
+
+    def __str__(self):
+        return f'<AnnotationRegistry annotations={len(self)} max={self.max_identifier}>'
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def __reversed__(self):
+        return reversed(self.ordered)
+
+    def __contains__(self, identifier: str):
+        return identifier in self.annotations
+
+    @staticmethod
+    def sort_key(annotation: 'Annotation') -> tuple:
+        start = -1 if annotation.start is None else annotation.start
+        end = -1 if annotation.end is None else annotation.end
+        return (start, end, annotation.identifier)
+
+    def get(self, identifier: str) -> 'Annotation':
+        return self.annotations.get(identifier)
+
+    def last(self) -> 'Annotation':
+        """Return the annotation that was added last."""
+        return next(reversed(self.annotations.values()), None)
+
+    def identifiers(self) -> list:
+        return [annotation.identifier for annotation in self.ordered]
+
+    def next_identifier(self) -> str:
+        """Return the identifier for a new annotation. Identifiers of removed
+        annotations are not handed out again."""
+        return f'a{self.max_identifier + 1:04d}'
+
+    def add(self, annotation: 'Annotation'):
+        """Add an annotation, replacing an annotation with the same identifier."""
+        self.remove(annotation.identifier)
+        self.annotations[annotation.identifier] = annotation
+        key = self.sort_key(annotation)
+        position = bisect.bisect(self.sort_keys, key)
+        self.sort_keys.insert(position, key)
+        self.ordered.insert(position, annotation)
+        self.index.add(annotation)
+        self.search_index.add(annotation.identifier, *annotation.search_document())
+        try:
+            number = int(annotation.identifier[1:])
+            self.max_identifier = max(self.max_identifier, number)
+        except ValueError:
+            pass
+
+    def remove(self, identifier: str) -> 'Annotation':
+        """Remove the annotation with the identifier and return it, returns None if
+        there is no such annotation."""
+        annotation = self.annotations.pop(identifier, None)
+        if annotation is not None:
+            position = bisect.bisect_left(self.sort_keys, self.sort_key(annotation))
+            del self.sort_keys[position]
+            del self.ordered[position]
+            self.index.remove(identifier)
+            self.search_index.remove(identifier)
+        return annotation
+
+    def search(self, query: str) -> list:
+        """Return the annotations that match the query, sorted on start time. See
+        Annotation.search_document() for what can be searched."""
+        if not query.strip():
+            return list(self.ordered)
+        annotations = [self.annotations[i] for i in self.search_index.search(query)]
+        return sorted(annotations, key=self.sort_key)
+
+
+class AnnotationIndex:
+
+    """Interval index over the saved annotations, with an IntervalTree for each
+    combination of task and tier. Trees are static, so adding or removing an
+    annotation drops the tree for its task and tier and the tree is rebuilt when
+    it is next needed. Annotations are saved a lot less often than the index is
+    queried, which happens on each rerun when adding annotations."""
+
+    def __init__(self, annotations: list = ()):
+        self.annotations = {}
+        self.trees = {}
+        self.keys = {}
+        for annotation in annotations:
+            self.add(annotation)
+
+    def __str__(self):
+        return f'<AnnotationIndex annotations={len(self.keys)}>'
+
+    def add(self, annotation: 'Annotation'):
+        key = (annotation.task, annotation.tier)
+        self.annotations.setdefault(key, {})[annotation.identifier] = annotation
+        self.keys[annotation.identifier] = key
+        self.trees.pop(key, None)
+
+    def remove(self, identifier: str):
+        key = self.keys.pop(identifier, None)
+        if key is not None:
+            self.annotations[key].pop(identifier, None)
+            self.trees.pop(key, None)
+
+    def tree(self, key: tuple) -> IntervalTree:
+        if key not in self.trees:
+            self.trees[key] = IntervalTree(
+                [(a.start, a.end, a) for a in self.annotations.get(key, {}).values()])
+        return self.trees[key]
+
+    def overlapping(self, start: int, end: int, task: str = None, tier: str = None) -> list:
+        """Return the annotations that overlap with the range from start to end in
+        milliseconds, sorted on start time. If a task or tier is given then only
+        annotations from that task or tier are returned."""
+        annotations = []
+        for key in list(self.annotations):
+            if (task is None or key[0] == task) and (tier is None or key[1] == tier):
+                annotations.extend(self.tree(key).overlapping(start, end))
+        return sorted(annotations, key=lambda a: (a.start, a.end))
+
+
 class ObjectPool:
 
+    @classmethod
+    def from_config(cls):
+        """Create a pool with the objects from the configuration."""
+        pool = cls()
+        for obj_type, objects in config.OBJECT_POOL.items():
+            pool.add_objects(obj_type, objects)
+        return pool
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict):
+        """Create a pool from the configuration and then move objects around to match
+        the snapshot. Objects that were added to the configuration after the snapshot
+        was taken are available."""
+        pool = cls.from_config()
+        for obj_type, objects in snapshot.items():
+            if obj_type not in pool.objects:
+                pool.add_object_type(obj_type)
+            inplay = set(objects['inplay'])
+            available = pool.objects[obj_type]['available'] | set(objects['available'])
+            pool.objects[obj_type] = {'available': available - inplay, 'inplay': inplay}
+        return pool
+
     def __init__(self):
         self.objects = {}
         self.object_types = []
@@ -134,6 +381,11 @@ class ObjectPool:
             pool[obj_type] = data
         return pool
 
+    def as_snapshot(self):
+        """Like as_json() but with sorted lists so it can be written to a file."""
+        return {obj_type: {k: sorted(v) for k, v in data.items()}
+                for obj_type, data in self.objects.items()}
+
 
 @functools.total_ordering
 class Annotation:
@@ -175,10 +427,7 @@ class Annotation:
         return self.start < other.start
 
     def assign_identifier(self):
-        max_identifier = 0
-        for annotation in st.session_state.annotations:
-            max_identifier = max(max_identifier, int(annotation.identifier[1:]))
-        self.identifier = f'a{max_identifier+1:04d}'
+        self.identifier = st.session_state.annotations.next_identifier()
 
     def import_fields(self, annotation: dict):
         self.identifier = annotation['identifier']
@@ -212,76 +461,31 @@ class Annotation:
             return None
         return self.timeframe.end.in_milliseconds()
 
-    def matches(self, term: str):
-        """Returns True if the search term occurs in the identifier, name or formula."""
-        if not term:
-            return True
-        term = term.lower()
-        if term in str(self.task).lower() + str(self.tier).lower():
-            return True
-        if term in self.name.lower() + self.identifier.lower():
-            return True
-        if term in self.as_formula().lower():
-            return True
-        if term in str(self.properties).lower():
-            return True
-        return False
+    def search_document(self) -> tuple:
+        """Return the text and the fields used by the search index. The text has the
+        task, tier, name, identifier, formula and properties, the fields are the
+        task, tier, identifier, name and predicate plus the arguments and properties,
+        so you can search for things like tier:action2 or pred:put."""
+        text = '\n'.join([
+            f'{self.task}{self.tier}', f'{self.name}{self.identifier}',
+            self.as_formula(), str(self.properties)])
+        fields = {**self.arguments, **self.properties}
+        fields.update({
+            'task': self.task, 'tier': self.tier, 'id': self.identifier,
+            'name': self.name, 'pred': self.predicate})
+        return text, fields
 
     def is_valid(self):
-        """Checker whether the annotation is not missing any required fields."""
-        self.errors = []
-        self.check_task_and_tier()
-        self.check_start_and_end()
-        self.check_predicate_and_arguments()
-        self.check_properties()
+        """Checker whether the annotation is not missing any required fields and
+        whether the values are allowed, using the validators compiled from the
+        configuration. Objects from the pool have to be in play."""
+        pool = st.session_state.get('pool')
+        objects = None
+        if pool is not None:
+            objects = lambda obj_type: pool.objects.get(obj_type, {}).get('inplay', ())
+        self.errors = get_validator().check(self.as_json(), objects)
         return True if not self.errors else False
 
-    def check_task_and_tier(self):
-        if self.task is None:
-            self.errors.append(f'WARNING: the task is not specified')
-        if self.tier is None:
-            self.errors.append(f'WARNING: the tier is not specified')
-
-    def check_start_and_end(self):
-        """Check the start and end values of the annotation, add the the erros list
-        if any errors were found."""
-        # TODO: add check for out of bounds start or end
-        if self.start is None:
-            self.errors.append(f'WARNING: the start position is not specified')
-        if self.end is None:
-            self.errors.append(f'WARNING: the end position is not specified')
-        if self.start is not None and self.end is not None:
-            if self.start > self.end:
-                self.errors.append(
-                    'WARNING: the start of the interval cannot be before the end')
-
-    def check_predicate_and_arguments(self):
-        """ Check the predicate and its arguments, add the the erros list
-        if any errors were found."""
-        if self.predicate is None:
-            self.errors.append(f'WARNING: the predicate is not specified')
-        if self.predicate:
-            argument_specifications = config.PREDICATES.get(self.predicate, {})
-            arguments_idx = { a['type']: a for a in argument_specifications }
-            for arg_name, arg_value in self.arguments.items():
-                optional = arguments_idx[arg_name].get('optional', False)
-                if not arg_value and not optional:
-                    self.errors.append(
-                        f'WARNING: required argument "{arg_name}" is not specified')
-
-    def check_properties(self):
-        """Check the properties dictionary of the annotation, add the the erros list
-        if any errors were found."""
-        properties_idx = { p['type']: p for p in config.PROPERTIES }
-        for prop, value in self.properties.items():
-            # There is something iffy here with the tier property which can be in
-            # the properties, but does not need to be in the defined properties
-            if prop not in properties_idx:
-                continue
-            optional = properties_idx[prop].get('optional', False)
-            if not value and not optional:
-                self.errors.append(f'WARNING: property "{prop}"" is not specified')
-
     def elan_identifier(self):
         """Cobble together an Elan "identifier" from the identifier and the start
         time. The elan identifier is more like a summary, using a prefix plus the
@@ -319,9 +523,12 @@ class Annotation:
         offsets = f'{start}\t{end}'
         return f'{self.tier}\t{offsets}\t{self.elan_identifier()}: {self.as_formula()}'
 
-    def as_row(self):
-        return [self.task, self.tier, self.identifier, self.name,
-                self.start_as_string(), self.end_as_string(),
+    def as_row(self, start: str = None, end: str = None):
+        """Return the annotation as a row for the annotations table. The start and
+        end can be handed in if they were already formatted."""
+        start = self.start_as_string() if start is None else start
+        end = self.end_as_string() if end is None else end
+        return [self.task, self.tier, self.identifier, self.name, start, end,
                 self.as_formula(), str(self.properties)]
 
     def start_as_string(self):
@@ -353,12 +560,12 @@ class Annotation:
             self.tier = selected_tier
         # Case 3: calculate the tier
         else:
-            taken = util.current_timeframes(self.task)
-            for name, taken_tf in taken:
-                if overlap(tf, taken_tf):
-                    self.tier = config.TIERS[1]
-                    return
-            self.tier = config.TIERS[0]
+            index = st.session_state.annotations.index
+            start, end = tf.start.in_milliseconds(), tf.end.in_milliseconds()
+            if index.overlapping(start, end, task=self.task):
+                self.tier = config.TIERS[1]
+            else:
+                self.tier = config.TIERS[0]
 
     def copy(self):
         return Annotation(
@@ -373,10 +580,12 @@ class Annotation:
     def save(self):
         if self.is_valid():
             self.assign_identifier()
-            st.session_state.annotations.append(self.copy())
-            json_file = st.session_state.io['json']
-            with open(json_file, 'a') as fh:
-                fh.write(json.dumps(self.as_json()) + '\n')
+            # This waits till the record is written so the annotation is not
+            # reported as saved before it is on disk, and if writing fails the
+            # annotation does not show up as saved either
+            st.session_state.store.append([self.as_json()])
+            st.session_state.annotations.add(self.copy())
+            st.session_state.video.contact_sheets.schedule([self])
             st.session_state.action_type = None
             util.log(f'Saved annotation {self.identifier} {self.as_formula()}')
         st.session_state.errors = self.errors
@@ -1,29 +1,322 @@
+import os
+import struct
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from config import default as config
+from util.store import locked_file
+import util
+
+
+# Returned by ImageCache.get() when the key is not in the cache, we cannot use None
+# because that is what we store when extracting an image failed.
+MISSING = object()
 
 
 class ImageCache:
 
     """Cache all images retrieved from the video. The images are indexed on the
-    offset in milliseconds in the video. Values are what is returned by the method
-    cv2.VideoCapture().read(), which is a Numpy array."""
+    frame number in the video. Values are thumbnails of what is returned by the
+    method cv2.VideoCapture().read(), encoded as JPEG or WebP bytes.
 
-    def __init__(self):
-        self.data = {}
+    The cache has a budget in bytes and when adding an image makes it go over the
+    budget then the least recently used images are evicted. The cache keeps count
+    of hits, misses and evictions, where hits and misses are counted by get(). It
+    also keeps track of what offsets in milliseconds were mapped to the frames in
+    the cache, which is used to report how many offsets share a frame."""
+
+    def __init__(self, budget: int = config.IMAGE_CACHE_SIZE * 1024 * 1024):
+        self.budget = budget
+        self.lock = threading.RLock()
+        self.reset()
 
     def __len__(self):
-        return len(self.data)
+        with self.lock:
+            return len(self.data)
 
     def __str__(self):
-        points = '{' + ' '.join([str(ms) for ms in self.data.keys()]) + '}'
-        return f'<ImageCache with {len(self)} timepoints  {points}>'
+        points = '{' + ' '.join([str(n) for n in self.keys()]) + '}'
+        return f'<ImageCache with {len(self)} frames  {points}>'
 
     def __getitem__(self, i):
-        return self.data[i]
+        with self.lock:
+            self.data.move_to_end(i)
+            return self.data[i]
 
     def __setitem__(self, i, val):
-        self.data[i] = val
+        with self.lock:
+            if i in self.data:
+                self.nbytes -= sizeof(self.data[i])
+            self.data[i] = val
+            self.data.move_to_end(i)
+            self.nbytes += sizeof(val)
+            while self.nbytes > self.budget and len(self.data) > 1:
+                key, evicted = self.data.popitem(last=False)
+                self.nbytes -= sizeof(evicted)
+                self.offsets.pop(key, None)
+                self.evictions += 1
 
     def __contains__(self, item):
-        return item in self.data
+        with self.lock:
+            return item in self.data
+
+    def keys(self) -> list:
+        """Return a copy of the keys, from least to most recently used."""
+        with self.lock:
+            return list(self.data)
+
+    def get(self, i, default=None):
+        """Return the value for the key and count a hit, or return the default and
+        count a miss if the key is not in the cache."""
+        with self.lock:
+            if i in self.data:
+                self.hits += 1
+                return self[i]
+            self.misses += 1
+            return default
+
+    def register_offsets(self, frame_numbers: dict):
+        """Register the offsets in the dictionary as mapping to the frame number
+        they are paired with."""
+        with self.lock:
+            for offset, frame_number in frame_numbers.items():
+                self.offsets.setdefault(frame_number, set()).add(offset)
+
+    def stats(self) -> dict:
+        # The cache is shared by threads, so take the numbers in one go
+        with self.lock:
+            images = len(self.data)
+            frames = len(self.offsets)
+            offsets = sum(len(offsets) for offsets in self.offsets.values())
+            nbytes, hits, misses = self.nbytes, self.hits, self.misses
+            evictions = self.evictions
+        lookups = hits + misses
+        return {
+            'images': images,
+            'offsets': offsets,
+            'dedup rate': round(1 - frames / offsets, 3) if offsets else None,
+            'megabytes': round(nbytes / (1024 * 1024), 2),
+            'budget (megabytes)': round(self.budget / (1024 * 1024), 2),
+            'hits': hits,
+            'misses': misses,
+            'hit rate': round(hits / lookups, 3) if lookups else None,
+            'evictions': evictions }
 
     def reset(self):
-        self.data = {}
+        with self.lock:
+            self.data = OrderedDict()
+            self.offsets = {}
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+class DiskCache:
+
+    """Thumbnails stored on disk so they are shared by all sessions and survive
+    restarts. Keys are tuples of video path, video modification time, frame number
+    and thumbnail width.
+
+    Thumbnails are appended to a pack file where each record has a header with a
+    digest of the key and the length of the thumbnail. Readers do not take locks,
+    each pack has a snapshot of its index that readers look up and read from. A
+    reader that does not find a thumbnail has the pack scan the records that other
+    sessions appended and swap in a new snapshot, unless another thread is already
+    doing that. Writers take an advisory lock on a lock file, and a writer lock so
+    threads in this process do not write at the same time.
+
+    The size is capped by using two generations of packs. When the current pack
+    grows beyond half of the budget it replaces the previous pack and a new current
+    pack is started. Thumbnails that are found in the previous pack are copied to
+    the current one by a background thread, so thumbnails in use survive and the
+    others are evicted."""
+
+    def __init__(self, path: str = config.DISK_CACHE_PATH,
+                 budget: int = config.DISK_CACHE_SIZE * 1024 * 1024):
+        self.path = path
+        self.budget = budget
+        self.current = Pack(f'{path}.pack')
+        self.previous = Pack(f'{path}.old.pack')
+        self.copies = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        scanned = self.current.snapshot.scanned + self.previous.snapshot.scanned
+        return f'<DiskCache {self.path} {scanned}>'
+
+    def get(self, key: tuple):
+        """Return the thumbnail for the key or None if it is not in the cache."""
+        digest = key_digest(key)
+        data = self.current.get(digest)
+        if data is None:
+            data = self.previous.get(digest)
+            if data is not None:
+                self.copy_forward(key, data)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key: tuple, data: bytes):
+        if data is None:
+            return
+        with self.writing, locked_file(f'{self.path}.lock'):
+            if os.path.exists(self.current.path) \
+                    and os.path.getsize(self.current.path) > self.budget // 2:
+                os.replace(self.current.path, self.previous.path)
+            self.current.append(key_digest(key), data)
+
+    def copy_forward(self, key: tuple, data: bytes):
+        """Have the background thread copy a thumbnail from the previous pack to the
+        current pack. The thread is started when there is work and it stops when
+        there is none left."""
+        with self.lock:
+            self.copies[key] = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.copies:
+                    self.thread = None
+                    return
+                key, data = self.copies.popitem()
+            try:
+                self.put(key, data)
+            except Exception as e:
+                util.error(f'Error copying {key} in the disk cache: {e}')
+
+    def stats(self) -> dict:
+        size = sum(os.path.getsize(pack.path)
+                   for pack in (self.current, self.previous)
+                   if os.path.exists(pack.path))
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'thumbnails': len(self.current.snapshot.index) + len(self.previous.snapshot.index),
+            'megabytes': round(size / (1024 * 1024), 2),
+            'hits': hits,
+            'misses': misses }
+
+
+# The open file of a pack, the inode of the file, the index from digests to the
+# location of thumbnails in the file, and where the last scan of the file ended
+Snapshot = namedtuple('Snapshot', 'file inode index scanned')
+
+
+class Pack:
+
+    """A file with thumbnail records, used by DiskCache. Readers use the snapshot
+    that is there and a refresh swaps in a new snapshot, so readers never wait for
+    a refresh. Snapshots are not changed after they are swapped in. The file is
+    reopened when it was replaced, the old file is closed when the last reader of
+    the old snapshot is done with it."""
+
+    header = struct.Struct('<16sI')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot = Snapshot(None, None, {}, 0)
+        self.refreshing = threading.Lock()
+
+    def get(self, digest: bytes):
+        snapshot = self.snapshot
+        if digest not in snapshot.index:
+            snapshot = self.refresh(wait=False)
+        location = snapshot.index.get(digest)
+        if location is None:
+            return None
+        return os.pread(snapshot.file.fileno(), location[1], location[0])
+
+    def refresh(self, wait: bool = True) -> Snapshot:
+        """Reopen the file if it was replaced and index the records appended since
+        the last scan, then return the snapshot. A record that is still being
+        written is skipped. If wait is False and another thread is refreshing then
+        the snapshot we have is returned right away."""
+        if not self.refreshing.acquire(blocking=wait):
+            return self.snapshot
+        try:
+            snapshot = self.snapshot
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                inode = None
+            if inode != snapshot.inode:
+                try:
+                    fh = open(self.path, 'rb')
+                    snapshot = Snapshot(fh, os.fstat(fh.fileno()).st_ino, {}, 0)
+                except FileNotFoundError:
+                    snapshot = Snapshot(None, None, {}, 0)
+            if snapshot.file is not None:
+                snapshot = self.scan(snapshot)
+            self.snapshot = snapshot
+            return snapshot
+        finally:
+            self.refreshing.release()
+
+    def scan(self, snapshot: Snapshot) -> Snapshot:
+        """Return a snapshot with the records after the end of the last scan added,
+        or the same snapshot if there are none."""
+        fileno = snapshot.file.fileno()
+        size = os.fstat(fileno).st_size
+        scanned = snapshot.scanned
+        added = {}
+        while scanned + self.header.size <= size:
+            header = os.pread(fileno, self.header.size, scanned)
+            digest, length = self.header.unpack(header)
+            offset = scanned + self.header.size
+            if offset + length > size:
+                break
+            added[digest] = (offset, length)
+            scanned = offset + length
+        if not added:
+            return snapshot
+        return snapshot._replace(index={**snapshot.index, **added}, scanned=scanned)
+
+    def append(self, digest: bytes, data: bytes):
+        """Append a record, this should only be done while holding the lock. If a
+        writer died halfway through a record then the partial record is removed."""
+        snapshot = self.refresh()
+        with open(self.path, 'ab') as fh:
+            if snapshot.file is not None and fh.tell() > snapshot.scanned:
+                fh.truncate(snapshot.scanned)
+            fh.write(self.header.pack(digest, len(data)) + data)
+
+
+def key_digest(key: tuple) -> bytes:
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+
+def get_disk_cache():
+    """Return the disk cache, which is shared by all sessions in the process, or
+    None if there is no budget for it."""
+    global disk_cache
+    with disk_cache_lock:
+        if disk_cache is None and config.DISK_CACHE_SIZE > 0:
+            disk_cache = DiskCache()
+    return disk_cache
+
+
+disk_cache = None
+disk_cache_lock = threading.Lock()
+
+
+def sizeof(image) -> int:
+    """Return the size of an image in bytes, the image can be a Numpy array or an
+    encoded image."""
+    if image is None:
+        return 0
+    return len(image) if isinstance(image, bytes) else image.nbytes
+
+
+'EOF'
@@ -0,0 +1,158 @@
+"""
+
+Export of annotations to ELAN files.
+
+The EAF file is written without building the XML in memory. Annotations are
+taken one by one, the time slots and the annotations of each tier are written to
+their own temporary files, and at the end those are copied into the EAF file in
+the order ELAN wants them.
+
+Exporting from the command line:
+
+$ python -m util.eaf data/VIDEO_FILE.json CONFIG_FILE
+$ python -m util.eaf data CONFIG_FILE
+
+The first writes data/VIDEO_FILE.eaf, the second writes an EAF file for each video
+in the data directory, but only for videos whose annotations changed since the last
+time. What was exported is kept in data/eaf.manifest.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from util.store import open_store, replay, annotation_files
+import util.annotation
+
+
+LINGUISTIC_TYPE = 'default-lt'
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<ANNOTATION_DOCUMENT AUTHOR="" DATE={date} FORMAT="3.0" VERSION="3.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://www.mpi.nl/tools/elan/EAFv3.0.xsd">
+    <HEADER MEDIA_FILE="" TIME_UNITS="milliseconds">
+{media}    </HEADER>
+'''
+
+MEDIA = '        <MEDIA_DESCRIPTOR MEDIA_URL={url} MIME_TYPE="video/mp4" RELATIVE_MEDIA_URL={relative}/>\n'
+
+TIME_SLOT = '        <TIME_SLOT TIME_SLOT_ID="ts{}" TIME_VALUE="{}"/>\n'
+
+ANNOTATION = '''        <ANNOTATION>
+            <ALIGNABLE_ANNOTATION ANNOTATION_ID={} TIME_SLOT_REF1="ts{}" TIME_SLOT_REF2="ts{}">
+                <ANNOTATION_VALUE>{}</ANNOTATION_VALUE>
+            </ALIGNABLE_ANNOTATION>
+        </ANNOTATION>
+'''
+
+FOOTER = f'''    <LINGUISTIC_TYPE GRAPHIC_REFERENCES="false" LINGUISTIC_TYPE_ID="{LINGUISTIC_TYPE}" TIME_ALIGNABLE="true"/>
+</ANNOTATION_DOCUMENT>
+'''
+
+
+def write_eaf(annotations, eaf_path: str, media_path: str = None) -> int:
+    """Write an EAF file from an iterable of annotations and return the number of
+    annotations written. Annotations without a start or end are skipped. Tiers are
+    in the order in which they were first seen."""
+    count = 0
+    slots = tempfile.TemporaryFile('w+', encoding='utf-8')
+    tiers = {}
+    try:
+        for annotation in annotations:
+            if annotation.start is None or annotation.end is None:
+                continue
+            count += 1
+            slots.write(TIME_SLOT.format(2 * count - 1, annotation.start))
+            slots.write(TIME_SLOT.format(2 * count, annotation.end))
+            tier = str(annotation.tier)
+            if tier not in tiers:
+                tiers[tier] = tempfile.TemporaryFile('w+', encoding='utf-8')
+            value = f'{annotation.elan_identifier()}: {annotation.as_formula()}'
+            tiers[tier].write(ANNOTATION.format(
+                quoteattr(annotation.identifier), 2 * count - 1, 2 * count, escape(value)))
+        tmp_path = f'{eaf_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            media = ''
+            if media_path is not None:
+                url = 'file://' + os.path.abspath(media_path)
+                relative = './' + os.path.basename(media_path)
+                media = MEDIA.format(url=quoteattr(url), relative=quoteattr(relative))
+            date = datetime.now().astimezone().isoformat(timespec='seconds')
+            fh.write(HEADER.format(date=quoteattr(date), media=media))
+            fh.write('    <TIME_ORDER>\n')
+            slots.seek(0)
+            shutil.copyfileobj(slots, fh)
+            fh.write('    </TIME_ORDER>\n')
+            for tier, spool in tiers.items():
+                fh.write(f'    <TIER LINGUISTIC_TYPE_REF="{LINGUISTIC_TYPE}"'
+                         f' TIER_ID={quoteattr(tier)}>\n')
+                spool.seek(0)
+                shutil.copyfileobj(spool, fh)
+                fh.write('    </TIER>\n')
+            fh.write(FOOTER)
+        os.replace(tmp_path, eaf_path)
+    finally:
+        slots.close()
+        for spool in tiers.values():
+            spool.close()
+    return count
+
+
+def stored_annotations(store):
+    """Generate the annotations in the store, sorted on start time."""
+    records, _ = store.read()
+    annotations = replay(records)
+    for identifier in sorted(annotations, key=lambda i: annotations[i]['start'] or 0):
+        yield util.annotation.Annotation().import_fields(annotations[identifier])
+
+
+def export_eaf(json_path: str, eaf_path: str = None, media_path: str = None) -> int:
+    """Write the annotations for the annotations file to an EAF file, which by
+    default is next to the annotations file."""
+    if eaf_path is None:
+        eaf_path = f'{os.path.splitext(json_path)[0]}.eaf'
+    return write_eaf(stored_annotations(open_store(json_path)), eaf_path, media_path)
+
+
+def export_eaf_directory(data_dir: str = 'data', force: bool = False) -> list:
+    """Write EAF files for all videos in the data directory whose annotations have
+    changed since the last export, or for all videos if force is True. Returns the
+    annotations files that were exported."""
+    manifest_path = os.path.join(data_dir, 'eaf.manifest')
+    manifest = {}
+    if os.path.isfile(manifest_path) and not force:
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+    exported = []
+    for json_path in annotation_files(data_dir):
+        eaf_path = f'{os.path.splitext(json_path)[0]}.eaf'
+        store = open_store(json_path)
+        signature = store.signature()
+        if manifest.get(json_path) == signature and os.path.isfile(eaf_path):
+            continue
+        write_eaf(stored_annotations(store), eaf_path)
+        manifest[json_path] = signature
+        exported.append(json_path)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return exported
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1]
+    if os.path.isdir(path):
+        for json_path in export_eaf_directory(path):
+            print(f'Exported {json_path}')
+    else:
+        count = export_eaf(path)
+        print(f'Exported {count} annotations from {path}')
+
+
+'EOF'
@@ -0,0 +1,161 @@
+"""
+
+Export of annotations to Parquet and import of Parquet files.
+
+The export has a row for each annotation and a column for each argument and
+property in the configuration, so analysis code can load a whole corpus with one
+read. The columns have the values as they are saved, which for inputs with more
+than one item is the value that util.process_arguments() made from the items.
+Inputs with just a list of options are stored as dictionary-encoded strings. The
+arguments and properties are also kept as JSON strings so that the import gets
+back exactly what was exported.
+
+Exporting and importing from the command line:
+
+$ python -m util.export data/VIDEO_FILE.json CONFIG_FILE
+$ python -m util.export data CONFIG_FILE
+$ python -m util.export data/VIDEO_FILE.parquet CONFIG_FILE
+
+The first writes data/VIDEO_FILE.parquet, the second writes the annotations of all
+videos to data/annotations.parquet and the third imports a Parquet file into the
+annotations files (or the database) in the data directory.
+
+"""
+
+import os
+import sys
+import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Only needed for exporting and importing, the tool runs fine without it
+    pa = None
+    pq = None
+
+from config import default as config
+from util.store import open_store, replay, annotation_files
+
+
+def check_pyarrow():
+    if pa is None:
+        raise RuntimeError('Exporting to Parquet needs pyarrow, do "pip install pyarrow"')
+
+
+def columns_from_config() -> list:
+    """Return the argument and property columns for the configuration, as a list
+    of (column, field, key, options) tuples. The field is 'arguments' or
+    'properties' and the key is the type of the argument or property. The options
+    flag is True for inputs that have one item which is a list of options."""
+    columns = {}
+    specifications = [('arguments', 'arg', spec)
+                      for specs in config.PREDICATES.values() for spec in specs]
+    specifications += [('properties', 'prop', spec) for spec in config.PROPERTIES]
+    for field, prefix, spec in specifications:
+        column = f'{prefix}_{spec["type"]}'
+        items = spec['items']
+        options = len(items) == 1 and isinstance(items[0], list)
+        # Different predicates can have arguments of the same type, the column
+        # only holds options if the input is just options everywhere
+        if column in columns:
+            options = options and columns[column][3]
+        columns[column] = (column, field, spec['type'], options)
+    return list(columns.values())
+
+
+def column_value(value):
+    if value is None or value == '':
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def annotations_table(json_paths: list) -> 'pa.Table':
+    """Return a table with the annotations from the annotations files."""
+    check_pyarrow()
+    extra_columns = columns_from_config()
+    data = {name: [] for name in (
+        'video', 'identifier', 'task', 'tier', 'name', 'start', 'end', 'predicate',
+        'arguments', 'properties')}
+    for column in extra_columns:
+        data[column[0]] = []
+    for json_path in json_paths:
+        video = os.path.splitext(os.path.basename(json_path))[0]
+        records, _ = open_store(json_path).read()
+        annotations = sorted(replay(records).values(),
+                             key=lambda a: (a['start'] is None, a['start'] or 0))
+        for annotation in annotations:
+            data['video'].append(video)
+            for name in ('identifier', 'task', 'tier', 'name', 'start', 'end', 'predicate'):
+                data[name].append(annotation.get(name))
+            data['arguments'].append(json.dumps(annotation.get('arguments', {})))
+            data['properties'].append(json.dumps(annotation.get('properties', {})))
+            for column, field, key, _ in extra_columns:
+                data[column].append(column_value(annotation.get(field, {}).get(key)))
+    arrays = {}
+    for name, values in data.items():
+        if name in ('start', 'end'):
+            arrays[name] = pa.array(values, pa.int64())
+        else:
+            arrays[name] = pa.array(values, pa.string())
+    for column, _, _, options in extra_columns:
+        if options:
+            arrays[column] = arrays[column].dictionary_encode()
+    for name in ('video', 'task', 'tier', 'predicate'):
+        arrays[name] = arrays[name].dictionary_encode()
+    return pa.table(arrays)
+
+
+def export_parquet(json_paths: list, parquet_path: str) -> int:
+    """Write the annotations from the annotations files to a Parquet file and return
+    the number of annotations written."""
+    table = annotations_table(json_paths)
+    tmp_path = f'{parquet_path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, parquet_path)
+    return table.num_rows
+
+
+def read_parquet(path: str, columns: list = None) -> 'pa.Table':
+    """Read a Parquet file, or a directory with Parquet files, in one go. Use the
+    to_pandas() method on the result to get a dataframe."""
+    check_pyarrow()
+    return pq.read_table(path, columns=columns)
+
+
+def import_parquet(parquet_path: str, data_dir: str = 'data') -> int:
+    """Add the annotations from a Parquet file to the annotations of their videos.
+    Annotations replace annotations with the same identifier. Returns the number of
+    annotations imported."""
+    columns = ['video', 'identifier', 'task', 'tier', 'name', 'start', 'end',
+               'predicate', 'arguments', 'properties']
+    rows = read_parquet(parquet_path, columns=columns).to_pylist()
+    videos = {}
+    for row in rows:
+        record = {name: row[name] for name in columns[1:]}
+        record['arguments'] = json.loads(record['arguments'])
+        record['properties'] = json.loads(record['properties'])
+        videos.setdefault(row['video'], []).append(record)
+    for video, records in videos.items():
+        open_store(os.path.join(data_dir, f'{video}.json')).append(records)
+    return len(rows)
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1]
+    if path.endswith('.parquet'):
+        count = import_parquet(path)
+        print(f'Imported {count} annotations from {path}')
+    else:
+        if os.path.isdir(path):
+            json_paths = annotation_files(path)
+            parquet_path = os.path.join(path, 'annotations.parquet')
+        else:
+            json_paths = [path]
+            parquet_path = f'{os.path.splitext(path)[0]}.parquet'
+        count = export_parquet(json_paths, parquet_path)
+        print(f'Exported {count} annotations to {parquet_path}')
+
+
+'EOF'
@@ -0,0 +1,82 @@
+"""
+
+Interval tree for time range queries.
+
+"""
+
+
+class IntervalTree:
+
+    """A centered interval tree over intervals with a value attached to them. The
+    tree is static, it is built in O(n log n) time from a list of intervals and
+    after that it finds the intervals that overlap with a range in O(log n + k)
+    time, where k is the number of intervals found.
+
+    Intervals are half-open like the time frames of annotations, so [3, 5) and
+    [5, 8) do not overlap. Each node has a center point and the intervals that
+    contain the center, sorted on start and sorted on end, intervals that end
+    before the center are in the left subtree and intervals that start after it
+    are in the right subtree."""
+
+    def __init__(self, intervals: list):
+        """Create the tree from a list of (start, end, value) triples."""
+        self.size = len(intervals)
+        self.root = self.build(sorted(intervals, key=lambda i: (i[0], i[1])))
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return f'<IntervalTree intervals={self.size}>'
+
+    def build(self, intervals: list):
+        """Build a node from intervals that are sorted on start. The center is the
+        start of the median interval so that every node has at least one interval
+        and both subtrees have at most half of the intervals."""
+        if not intervals:
+            return None
+        center = intervals[len(intervals) // 2][0]
+        left, here, right = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        return (center, here, by_end, self.build(left), self.build(right))
+
+    def overlapping(self, start, end) -> list:
+        """Return the values of all intervals that overlap with [start, end), in no
+        particular order."""
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            center, by_start, by_end, left, right = node
+            if end <= center:
+                # Everything on the right starts too late, intervals here can end
+                # on the center so they may still end before the range starts
+                for interval in by_start:
+                    if interval[0] >= end:
+                        break
+                    if interval[1] > start:
+                        found.append(interval[2])
+                nodes.append(left)
+            elif start >= center:
+                for interval in by_end:
+                    if interval[1] <= start:
+                        break
+                    found.append(interval[2])
+                nodes.append(right)
+            else:
+                found.extend(interval[2] for interval in by_start)
+                nodes.append(left)
+                nodes.append(right)
+        return found
+
+
+'EOF'
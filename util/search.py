@@ -0,0 +1,98 @@
+"""
+
+Search index for the annotation list.
+
+"""
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+
+    """Inverted index from trigrams to the keys of the documents that have them. A
+    document is a lowercased text blob plus a dictionary of lowercased fields, the
+    blob is for plain search terms and the fields are for terms like tier:action2.
+    Blobs and fields are made once when a document is added.
+
+    A query is split on white space and a document matches if all parts match. A
+    part matches if it occurs in the blob, or for field:value parts, if the value
+    occurs in the field. Parts with three or more characters are looked up in the
+    index, which gives the documents that have all trigrams of the part, and then
+    only those documents are checked. Shorter parts are checked against all blobs,
+    which is still cheap because the blobs are ready to go."""
+
+    def __init__(self):
+        self.blobs = {}
+        self.fields = {}
+        self.grams = {}
+        self.postings = {}
+        self.field_names = {}
+
+    def __str__(self):
+        return f'<SearchIndex documents={len(self.blobs)} trigrams={len(self.postings)}>'
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def add(self, key, blob: str, fields: dict):
+        """Add a document, replacing the document with the same key."""
+        self.remove(key)
+        blob = blob.lower()
+        fields = {name.lower(): str(value).lower() for name, value in fields.items()}
+        grams = trigrams(blob)
+        for value in fields.values():
+            grams.update(trigrams(value))
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(key)
+        for name in fields:
+            self.field_names[name] = self.field_names.get(name, 0) + 1
+        self.blobs[key] = blob
+        self.fields[key] = fields
+        self.grams[key] = grams
+
+    def remove(self, key):
+        if key not in self.blobs:
+            return
+        for gram in self.grams.pop(key):
+            keys = self.postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+        for name in self.fields.pop(key):
+            self.field_names[name] -= 1
+            if not self.field_names[name]:
+                del self.field_names[name]
+        del self.blobs[key]
+
+    def search(self, query: str) -> set:
+        """Return the keys of the documents that match the query."""
+        found = None
+        for part in query.lower().split():
+            name, _, value = part.partition(':')
+            if value and name in self.field_names:
+                keys = self.candidates(value, found)
+                keys = {k for k in keys if value in self.fields[k].get(name, '')}
+            else:
+                keys = self.candidates(part, found)
+                keys = {k for k in keys if part in self.blobs[k]}
+            found = keys
+            if not found:
+                break
+        return set(self.blobs) if found is None else found
+
+    def candidates(self, text: str, keys: set = None) -> set:
+        """Return the keys of documents that may have the text, limited to the keys
+        handed in if there are any."""
+        sets = [keys] if keys is not None else []
+        grams = trigrams(text)
+        if grams:
+            sets.extend(self.postings.get(gram, set()) for gram in grams)
+        elif keys is None:
+            return set(self.blobs)
+        sets.sort(key=len)
+        return set.intersection(*sets) if len(sets) > 1 else set(sets[0])
+
+
+'EOF'
@@ -0,0 +1,538 @@
+"""
+
+Storage for annotations and object pool events.
+
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import threading
+import contextlib
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where locked_file() does not lock and sessions that
+    # write the same file at the same time can get in each other's way
+    fcntl = None
+
+from config import default as config
+
+
+def open_store(json_path: str):
+    """Return the store for the annotations of a video given its annotations file.
+    This is the file itself unless ANNOTATION_STORE is set to 'sqlite', in which
+    case the annotations file is imported into the database the first time the
+    video is seen."""
+    if config.ANNOTATION_STORE != 'sqlite':
+        return JsonlStore(json_path)
+    video = os.path.splitext(os.path.basename(json_path))[0]
+    store = SqliteStore(config.ANNOTATION_DATABASE, video)
+    if not store.exists() and os.path.isfile(json_path):
+        store.import_jsonl(json_path)
+    return store
+
+
+def replay(records: list) -> dict:
+    """Return the annotations that are left after applying the records, as a
+    dictionary from identifiers to annotation records. This is for use outside of
+    the tool, the tool itself uses apply_records() in util.annotation."""
+    annotations = {}
+    for record in records:
+        if 'snapshot' in record:
+            annotations = {a['identifier']: a for a in record['snapshot']['annotations']}
+        elif 'remove-annotation' in record:
+            annotations.pop(record['remove-annotation'], None)
+        elif 'identifier' in record:
+            annotations.pop(record['identifier'], None)
+            annotations[record['identifier']] = record
+    return annotations
+
+
+def annotation_files(data_dir: str = 'data') -> list:
+    """Return the annotations files in the data directory, or the names they would
+    have if the annotations are in the database."""
+    if config.ANNOTATION_STORE == 'sqlite':
+        if not os.path.isfile(config.ANNOTATION_DATABASE):
+            return []
+        connection = sqlite3.connect(config.ANNOTATION_DATABASE)
+        with contextlib.closing(connection):
+            videos = [video for video, in connection.execute('SELECT video FROM videos')]
+        return sorted(os.path.join(data_dir, f'{video}.json') for video in videos)
+    return sorted(
+        os.path.join(data_dir, name) for name in os.listdir(data_dir)
+        if name.endswith('.json'))
+
+
+@contextlib.contextmanager
+def locked_file(path: str):
+    """Lock the file for writing, yields the file handle opened for appending. The
+    lock is an advisory lock that only keeps out others that use this function, and
+    on Windows there is no lock at all."""
+    while True:
+        fh = open(path, 'a')
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        # If the file was replaced while we waited for the lock then the handle is
+        # for the old file and we need to try again
+        if os.path.exists(path) and os.path.samestat(os.fstat(fh.fileno()), os.stat(path)):
+            break
+        fh.close()
+    try:
+        yield fh
+    finally:
+        fh.close()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(path: str) -> 'LogWriter':
+    """Return the writer for the file at the path, all stores for the same file in
+    this process share one writer."""
+    key = os.path.abspath(path)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = LogWriter(path)
+        return _writers[key]
+
+
+class LogWriter:
+
+    """Writes records to the end of a log file in a background thread. Records that
+    come in within WRITE_WINDOW seconds of each other are written together, with
+    one write while holding the lock on the file and, depending on the fsync policy
+    in ANNOTATION_FSYNC, one fsync.
+
+    Each call to write() gets a future, which gets the identity of the file and the
+    positions where its records start and end once they are written, or the error
+    if writing failed."""
+
+    def __init__(self, path: str, window: float = None, fsync: str = None):
+        self.path = path
+        self.window = config.ANNOTATION_WRITE_WINDOW if window is None else window
+        self.fsync = config.ANNOTATION_FSYNC if fsync is None else fsync
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __str__(self):
+        return (f'<{self.__class__.__name__} {self.path}'
+                f' writes={self.writes} batches={self.batches}>')
+
+    def write(self, records: list) -> Future:
+        future = Future()
+        self.queue.put((records, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.write_batch([records for records, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+    def write_batch(self, batch: list) -> list:
+        chunks = [''.join(json.dumps(record) + '\n' for record in records)
+                  for records in batch]
+        with locked_file(self.path) as fh:
+            stat = os.fstat(fh.fileno())
+            identity = (stat.st_dev, stat.st_ino)
+            start = fh.seek(0, os.SEEK_END)
+            data = memoryview(''.join(chunks).encode('utf-8'))
+            while data:
+                data = data[os.write(fh.fileno(), data):]
+            if self.fsync == 'batch':
+                os.fsync(fh.fileno())
+        results = []
+        for chunk in chunks:
+            end = start + len(chunk.encode('utf-8'))
+            results.append((identity, start, end))
+            start = end
+        self.batches += 1
+        self.writes += len(batch)
+        return results
+
+
+class JsonlStore:
+
+    """The annotations file, which is a log of JSON records with one record on each
+    line. Records are annotations, removals of annotations, and objects being put
+    in play or taken out of play. Records are only ever appended.
+
+    The store remembers how far it has read and what file it was reading from, so
+    read() only returns the records that were added since the last read. It starts
+    reading from scratch when the file was truncated or replaced. Records written
+    by this store are skipped by the next read, unless somebody else wrote to the
+    file in the meantime.
+
+    Writing is done by the LogWriter for the file, which is shared with the other
+    stores on the file. Appending does not have to wait for the writer, the records
+    written are accounted for by flush(), which waits for the writer to finish and
+    which is also done before reading.
+
+    The file can be replaced with a shorter version with replace(), the old file
+    is kept as a backup. Writers lock the file, and a writer that finds out that
+    the file it locked was replaced in the meantime locks the new file instead."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.backup_path = f'{path}.bak'
+        self.offset = 0
+        self.identity = None
+        self.records = 0
+        self.writer = get_log_writer(path)
+        self.pending = []
+
+    def __str__(self):
+        return (f'<{self.__class__.__name__} {self.path}'
+                f' offset={self.offset} records={self.records}>')
+
+    def file_identity(self) -> tuple:
+        stat = os.stat(self.path)
+        return (stat.st_dev, stat.st_ino), stat.st_size
+
+    def signature(self) -> list:
+        """Returns something that changes when the annotations change."""
+        self.flush()
+        if not os.path.isfile(self.path):
+            return None
+        stat = os.stat(self.path)
+        return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def read(self) -> tuple:
+        """Returns the records added since the last read and a boolean that is True
+        if the records are all records in the file rather than just the new ones.
+        An incomplete last line, which may be in the middle of being written, is
+        left for the next read."""
+        self.flush()
+        if not os.path.isfile(self.path):
+            open(self.path, 'a').close()
+        identity, size = self.file_identity()
+        full = identity != self.identity or size < self.offset
+        if full:
+            self.offset = 0
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            data = fh.read()
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        self.identity = identity
+        records = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        self.records = len(records) if full else self.records + len(records)
+        return records, full
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Lock the file for writing, yields the file handle opened for appending.
+        Our own records are flushed first because the writer needs the lock."""
+        self.flush()
+        with locked_file(self.path) as fh:
+            yield fh
+
+    def append(self, records: list, wait: bool = True):
+        """Append records to the file. If wait is True this returns when the records
+        are written, and synced to disk if the fsync policy says so, otherwise it
+        returns right away and the records are accounted for by the next flush."""
+        self.pending.append((len(records), self.writer.write(records)))
+        if wait:
+            self.flush()
+
+    def flush(self):
+        """Wait till all records appended by this store are written. If nobody else
+        wrote to the file in the meantime we skip over our records when reading. If
+        writing failed then we still wait for and account for the other writes, and
+        raise the first error at the end."""
+        pending, self.pending = self.pending, []
+        error = None
+        for count, future in pending:
+            try:
+                identity, start, end = future.result()
+            except Exception as e:
+                error = e if error is None else error
+                continue
+            if start == self.offset and identity == self.identity:
+                self.offset = end
+                self.records += count
+        if error is not None:
+            raise error
+
+    def replace(self, records: list):
+        """Replace the file with a file that has the records, the old file is kept as
+        a backup. This should be called while holding the lock from locked() and it
+        assumes the caller has read everything that is in the file."""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fh:
+            for record in records:
+                fh.write(json.dumps(record) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.path.exists(self.backup_path):
+            os.remove(self.backup_path)
+        os.link(self.path, self.backup_path)
+        os.replace(tmp_path, self.path)
+        self.identity, self.offset = self.file_identity()
+        self.records = len(records)
+
+
+class SqliteStore:
+
+    """Annotations for all videos in one SQLite database, with the same interface as
+    JsonlStore so the rest of the tool does not know the difference. Instead of a
+    log the database has the current state: a row for each annotation and for each
+    object that was put in play or taken out of play. Removed annotations are kept
+    as rows marked as removed until the store is compacted.
+
+    Every change to a video gets the next number from the sequence of the video and
+    the store remembers the last number it has seen, so read() only returns what
+    changed since the last read. The first read returns everything as one snapshot
+    record, and so does a read after another session compacted the store."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS videos (
+            video TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL DEFAULT 0,
+            compacted INTEGER NOT NULL DEFAULT 0,
+            max_identifier INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS annotations (
+            video TEXT NOT NULL,
+            identifier TEXT NOT NULL,
+            task TEXT,
+            tier TEXT,
+            start INTEGER,
+            end INTEGER,
+            record TEXT NOT NULL,
+            removed INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (video, identifier));
+        CREATE INDEX IF NOT EXISTS annotations_position
+            ON annotations (video, task, tier, start);
+        CREATE INDEX IF NOT EXISTS annotations_identifier ON annotations (identifier);
+        CREATE INDEX IF NOT EXISTS annotations_seq ON annotations (video, seq);
+        CREATE TABLE IF NOT EXISTS objects (
+            video TEXT NOT NULL,
+            type TEXT NOT NULL,
+            object TEXT NOT NULL,
+            inplay INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (video, type, object));'''
+
+    def __init__(self, path: str, video: str):
+        self.path = path
+        self.video = video
+        self.backup_path = f'{path}.bak'
+        self.seq = None
+        self.records = 0
+        # Sessions are not tied to one thread, but each session has its own store
+        # and only uses it from one thread at a time
+        self.connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        synchronous = 'FULL' if config.ANNOTATION_FSYNC == 'batch' else 'NORMAL'
+        self.connection.execute(f'PRAGMA synchronous={synchronous}')
+        self.connection.executescript(self.SCHEMA)
+
+    def __str__(self):
+        return (f'<{self.__class__.__name__} {self.path} video={self.video}'
+                f' seq={self.seq} records={self.records}>')
+
+    def exists(self) -> bool:
+        """Returns True if the video is in the database."""
+        return self.execute('SELECT 1 FROM videos WHERE video = ?').fetchone() is not None
+
+    def signature(self) -> list:
+        """Returns something that changes when the annotations change."""
+        row = self.execute('SELECT seq, compacted FROM videos WHERE video = ?').fetchone()
+        return list(row) if row else None
+
+    def execute(self, query: str, *parameters):
+        return self.connection.execute(query, (self.video, *parameters))
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Start a write transaction, which locks the database for other writers, and
+        commit it at the end. Does nothing if we are already in a transaction."""
+        if self.connection.in_transaction:
+            yield self.connection
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def read(self) -> tuple:
+        """Returns the records added since the last read and a boolean that is True
+        if the records are all records for the video rather than just the new ones."""
+        with self.locked():
+            row = self.execute('SELECT seq, compacted FROM videos WHERE video = ?').fetchone()
+            seq, compacted = row if row else (0, 0)
+            full = self.seq is None or self.seq < compacted
+            if full:
+                records = [self.snapshot()]
+            else:
+                records = []
+                for obj_type, obj, inplay in self.execute(
+                        'SELECT type, object, inplay FROM objects'
+                        ' WHERE video = ? AND seq > ? ORDER BY seq', self.seq):
+                    records.append({'add-object' if inplay else 'remove-object': [obj_type, obj]})
+                for identifier, record, removed in self.execute(
+                        'SELECT identifier, record, removed FROM annotations'
+                        ' WHERE video = ? AND seq > ? ORDER BY seq', self.seq):
+                    records.append(
+                        {'remove-annotation': identifier} if removed else json.loads(record))
+            self.records = self.execute(
+                'SELECT COUNT(*) FROM annotations WHERE video = ?').fetchone()[0]
+            self.seq = seq
+        return records, full
+
+    def snapshot(self) -> dict:
+        annotations = [
+            json.loads(record) for record, in self.execute(
+                'SELECT record FROM annotations WHERE video = ? AND NOT removed'
+                ' ORDER BY start, identifier')]
+        pool = {}
+        for obj_type, obj, inplay in self.execute(
+                'SELECT type, object, inplay FROM objects WHERE video = ?'):
+            objects = pool.setdefault(obj_type, {'available': [], 'inplay': []})
+            objects['inplay' if inplay else 'available'].append(obj)
+        # Removed annotations count too so their identifiers are not used again,
+        # and so do annotations that were removed before the last compaction
+        row = self.execute('SELECT max_identifier FROM videos WHERE video = ?').fetchone()
+        number = self.execute(
+            'SELECT MAX(CAST(SUBSTR(identifier, 2) AS INTEGER))'
+            ' FROM annotations WHERE video = ?').fetchone()[0]
+        max_identifier = max(row[0] if row else 0, number or 0)
+        return {'snapshot': {'annotations': annotations, 'pool': pool,
+                             'max_identifier': max_identifier}}
+
+    def append(self, records: list, wait: bool = True):
+        """Add records to the database. This always waits for the transaction to be
+        committed, the wait argument is there to match JsonlStore."""
+        with self.locked():
+            self.execute('INSERT OR IGNORE INTO videos (video) VALUES (?)')
+            seq = self.execute('SELECT seq FROM videos WHERE video = ?').fetchone()[0]
+            # Only skip our own changes on the next read if nobody else wrote since
+            # our last read
+            caught_up = seq == self.seq
+            for record in records:
+                seq = self.write(record, seq)
+            self.execute('UPDATE videos SET seq = ?2 WHERE video = ?1', seq)
+            if caught_up:
+                self.seq = seq
+
+    def flush(self):
+        """Nothing to do here since append() always waits."""
+
+    def write(self, record: dict, seq: int) -> int:
+        """Write one record and return the last sequence number used."""
+        # The video is always the first parameter, queries that need it somewhere
+        # else use numbered parameters
+        if 'snapshot' in record:
+            for obj_type, objects in record['snapshot']['pool'].items():
+                for key in ('available', 'inplay'):
+                    for obj in objects[key]:
+                        seq = self.write({'add-object' if key == 'inplay' else 'remove-object':
+                                          [obj_type, obj]}, seq)
+            for annotation in record['snapshot']['annotations']:
+                seq = self.write(annotation, seq)
+            self.execute(
+                'UPDATE videos SET max_identifier = MAX(max_identifier, ?2) WHERE video = ?1',
+                record['snapshot'].get('max_identifier', 0))
+        elif 'add-object' in record or 'remove-object' in record:
+            inplay = 'add-object' in record
+            obj_type, obj = record['add-object' if inplay else 'remove-object'][:2]
+            seq += 1
+            self.execute(
+                'INSERT OR REPLACE INTO objects (video, type, object, inplay, seq)'
+                ' VALUES (?, ?, ?, ?, ?)', obj_type, obj, int(inplay), seq)
+        elif 'remove-annotation' in record:
+            seq += 1
+            self.execute(
+                'UPDATE annotations SET removed = 1, seq = ?2'
+                ' WHERE video = ?1 AND identifier = ?3', seq, record['remove-annotation'])
+        else:
+            seq += 1
+            self.execute(
+                'INSERT OR REPLACE INTO annotations'
+                ' (video, identifier, task, tier, start, end, record, removed, seq)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                record['identifier'], record.get('task'), record.get('tier'),
+                record.get('start'), record.get('end'), json.dumps(record), seq)
+        return seq
+
+    def replace(self, records: list):
+        """Replace what we have for the video with the records, after making a backup
+        of the database. This should be called while holding the lock from locked()
+        and it assumes the caller has read everything there is for the video. Other
+        sessions will read everything again on their next read."""
+        # The backup needs its own connection because ours is in the middle of a
+        # write transaction, in WAL mode it can still read what was committed
+        with contextlib.closing(sqlite3.connect(self.path)) as source:
+            with contextlib.closing(sqlite3.connect(self.backup_path)) as backup:
+                source.backup(backup)
+        # The video may not have a row yet if nothing was ever written for it
+        self.execute('INSERT OR IGNORE INTO videos (video) VALUES (?)')
+        self.execute('DELETE FROM annotations WHERE video = ?')
+        self.execute('DELETE FROM objects WHERE video = ?')
+        seq = self.execute('SELECT seq FROM videos WHERE video = ?').fetchone()[0]
+        for record in records:
+            seq = self.write(record, seq)
+        self.execute('UPDATE videos SET seq = ?2, compacted = ?2 WHERE video = ?1', seq)
+        self.seq = seq
+        self.records = self.execute(
+            'SELECT COUNT(*) FROM annotations WHERE video = ?').fetchone()[0]
+
+    def import_jsonl(self, path: str):
+        """Import an annotations file, replacing what we have for the video."""
+        records, _ = JsonlStore(path).read()
+        with self.locked():
+            self.execute('INSERT OR IGNORE INTO videos (video) VALUES (?)')
+            self.execute('DELETE FROM annotations WHERE video = ?')
+            self.execute('DELETE FROM objects WHERE video = ?')
+            seq = self.execute('SELECT seq FROM videos WHERE video = ?').fetchone()[0]
+            for record in records:
+                seq = self.write(record, seq)
+            self.execute('UPDATE videos SET seq = ?2, compacted = ?2 WHERE video = ?1', seq)
+        return len(records)
+
+
+if __name__ == '__main__':
+
+    # Import an annotations file into the database from the configuration, the name
+    # of the file without the extension is used as the name of the video:
+    #
+    # $ python -m util.store data/VIDEO_FILE.json config/TASK_CONFIG.py
+    #
+    # Like with the annotator the second argument is the task configuration.
+    json_path = sys.argv[1]
+    video = os.path.splitext(os.path.basename(json_path))[0]
+    count = SqliteStore(config.ANNOTATION_DATABASE, video).import_jsonl(json_path)
+    print(f'Imported {count} records from {json_path} into {config.ANNOTATION_DATABASE}')
+
+
+'EOF'
@@ -8,7 +8,6 @@ Includes session state utilities, display utilities and action utilities.
 
 import os
 import sys
-import json
 import datetime
 import pathlib
 
@@ -18,10 +17,12 @@ import streamlit_timeline
 
 from config import default as config
 import util
-from util.video import Video, TimePoint, TimeFrame, collect_frames
+from util.video import TimePoint, TimeFrame, Prefetcher, collect_frames
+from util.video import get_video_registry, timestamps
 from util.annotation import Annotation, ObjectPool
 from util.annotation import annotation_identifiers, load_annotations
-from util.cache import ImageCache
+from util.cache import get_disk_cache
+from util.store import open_store
 
 
 # Session state utilities
@@ -46,20 +47,38 @@ def intialize_session_state():
             'config_path': config_path,
             'json': f'data/{basename}.json',
             'elan': f'data/{basename}.tab',
-            'log': f'data/{basename}.log'}
+            'eaf': f'data/{basename}.eaf',
+            'parquet': f'data/{basename}.parquet',
+            'log': f'data/{basename}.log',
+            'index': f'data/{basename}.frames.npy',
+            'proxy': f'data/{basename}.proxy.avi',
+            'filmstrip': f'data/{basename}.filmstrip',
+            'motion': f'data/{basename}.motion.npy'}
     if 'video' not in st.session_state:
-        st.session_state.video = Video(video_path)
+        # The video, its decoders and its image cache are shared by all sessions
+        io = st.session_state.io
+        proxy_path = io['proxy'] if config.USE_PROXY else None
+        st.session_state.lease = get_video_registry().open(
+            video_path, io['index'], proxy_path=proxy_path,
+            filmstrip_path=io['filmstrip'], motion_path=io['motion'],
+            disk_cache=get_disk_cache())
+        st.session_state.video = st.session_state.lease.video
         util.log(f'Loaded video at {video_path}')
     if 'pool' not in st.session_state:
-        st.session_state.pool = ObjectPool()
-        for obj_type, objects in config.OBJECT_POOL.items():
-            st.session_state.pool.add_objects(obj_type, objects)
+        st.session_state.pool = ObjectPool.from_config()
+    if 'store' not in st.session_state:
+        st.session_state.store = open_store(st.session_state.io['json'])
     if 'annotations' not in st.session_state:
         load_annotations()
     if 'annotation' not in st.session_state:
         st.session_state.annotation = Annotation()
     if 'cache' not in st.session_state:
-        st.session_state.cache = ImageCache()
+        st.session_state.cache = st.session_state.video.cache
+    if 'prefetcher' not in st.session_state:
+        st.session_state.prefetcher = Prefetcher(
+            st.session_state.video, st.session_state.cache)
+    if 'batches' not in st.session_state:
+        st.session_state.batches = {}
     if 'errors' not in st.session_state:
         st.session_state.errors = []
     if 'messages' not in st.session_state:
@@ -100,6 +119,9 @@ def sidebar_display_video_controls():
     st.sidebar.header('Video controls', divider=True)
     offset = sidebar_display_seek_inputs()
     st.sidebar.write(offset)
+    preview = st.session_state.video.filmstrip.thumbnail(offset.in_milliseconds())
+    if preview is not None:
+        st.sidebar.image(preview)
     width = sidebar_display_width_slider()
     return offset, width
 
@@ -176,9 +198,11 @@ def display_capture_boundaries():
     with col1:
         tp1 = display_seek_inputs('Start', keys=keys1)
         st.write(tp1)
+        display_snap_points(tp1, keys=keys1)
     with col2:
         tp2 = display_seek_inputs('End', keys=keys2)
         st.write(tp2)
+        display_snap_points(tp2, keys=keys2)
     # Trap out of bounds errors
     video_length = len(st.session_state.video)
     if tp2.in_seconds() > video_length:
@@ -206,19 +230,45 @@ def display_seek_inputs(header: str, keys: list):
     return TimePoint(
         hours=hours, minutes=minutes, seconds=seconds, milliseconds=mseconds)
 
-def display_left_boundary(timeframe: 'TimeFrame'):
-    #st.write('**Showing left boundary**')
-    ms = timeframe.start.in_milliseconds()
-    timepoint = TimePoint(milliseconds=ms)
-    frames = collect_frames(timeframe.video, util.get_window(ms))
-    display_sliding_window(st, frames, timepoint)
-
-def display_right_boundary(timeframe: 'TimeFrame'):
-    #st.write('**Showing right boundary**')
-    ms = timeframe.end.in_milliseconds()
-    timepoint = TimePoint(milliseconds=ms)
-    frames = collect_frames(timeframe.video, util.get_window(ms))
-    display_sliding_window(st, frames, timepoint)
+def display_snap_points(timepoint: TimePoint, keys: list):
+    """Display buttons for points near the timepoint where motion starts or stops,
+    clicking a button moves the timepoint there."""
+    offset = timepoint.in_milliseconds()
+    snap_points = st.session_state.video.motion.snap_points(offset)
+    snap_points = [ms for ms in snap_points if ms != offset]
+    if not snap_points:
+        return
+    cols = st.columns([3] + [5] * len(snap_points) + [4])
+    cols[0].markdown('Motion')
+    for col, ms in zip(cols[1:], snap_points):
+        col.button(
+            TimePoint(milliseconds=ms).timestamp(short=True), key=f'{keys[0]}_{ms}',
+            on_click=action_snap_to, args=[ms, keys])
+
+def display_boundaries(timeframe: 'TimeFrame'):
+    """Display the frames around the start and the end of the timeframe. Frames for
+    both windows are collected in one go so they can be extracted in parallel."""
+    left = util.get_window(timeframe.start.in_milliseconds())
+    right = util.get_window(timeframe.end.in_milliseconds())
+    frames = collect_frames(timeframe.video, left + right, batch='boundaries')
+    display_sliding_window(st, frames[:len(left)], timeframe.start)
+    display_sliding_window(st, frames[len(left):], timeframe.end)
+    prefetch_boundaries(timeframe)
+
+def prefetch_boundaries(timeframe: 'TimeFrame'):
+    """Prefetch frames for where the annotator is likely to go next: the windows a
+    bit before and after the start and end of the timeframe, and the window at the
+    end of the last saved annotation."""
+    if not config.PREFETCH_DISTANCE:
+        return
+    timepoints = []
+    for tp in (timeframe.start, timeframe.end):
+        ms = tp.in_milliseconds()
+        timepoints.extend([ms - config.PREFETCH_DISTANCE, ms + config.PREFETCH_DISTANCE])
+    if st.session_state.annotations:
+        timepoints.append(st.session_state.annotations.last().end)
+    windows = [util.get_window(ms) for ms in timepoints if ms >= 0]
+    st.session_state.prefetcher.prefetch(windows)
 
 def display_timepoint_tuner(label: str, tf: 'TimeFrame', tp: 'TimePoint'):
     step = datetime.timedelta(milliseconds=config.CONTEXT_STEP)
@@ -243,19 +293,10 @@ def display_sliding_window(column, frames, tp, header=None):
                 is_focus = True
             display_frame(cols[i], frame, focus=is_focus)
 
-def display_frames(column, frames, cols=10, header=None):
-    """Display frames horizontally in a box."""
-    box = column.container(border=True)
-    if header is not None:
-        box.write(header)
-    cols = box.columns(cols)
-    for i, frame in enumerate(frames):
-        display_frame(cols[i], frame)
-
 def display_frame(column, frame, focus=False):
     caption = f'✔︎' if focus else frame.caption()
     if frame.success:
-        column.image(frame.image, channels="BGR", caption=caption)
+        column.image(frame.image, caption=caption)
     # TODO: on failure may want to pass in an empty image with a caption like
     # below, but before that need to figure out how to control the size of the
     # image better (that is make it match the video screen dimensions).
@@ -313,12 +354,11 @@ def display_annotation(annotation, show_options: dict):
 def display_annotations(settings: dict):
     with st.container(border=True):
         term = st.text_input('Search annotations')
-        filtered_annotations = \
-            [a for a in reversed(st.session_state.annotations) if a.matches(term)]
+        filtered_annotations = st.session_state.annotations.search(term)
         if not settings['hide-timeline']:
             display_annotations_timeline(filtered_annotations)
         if not settings['hide-table']:
-            display_annotations_table(sorted(filtered_annotations))
+            display_annotations_table(filtered_annotations)
 
 def display_annotations_timeline(annotations: list):
     def annotation_pp(anno: dict):
@@ -326,9 +366,9 @@ def display_annotations_timeline(annotations: list):
             return None
         annotation = Annotation().import_fields(anno)
         st.write(annotation)
-        offsets = list(range(annotation.start, annotation.end, 500))
-        frames = collect_frames(st.session_state.video, offsets[:10])
-        display_frames(st, frames, cols=10)
+        sheet = st.session_state.video.contact_sheets.get(annotation)
+        if sheet is not None:
+            st.image(sheet)
     tiers = sorted(set([a.tier for a in annotations if a.tier]))
     groups = [{"id": tier, "content": tier.lower()} for tier in tiers]
     # Arrived at these numbers experimentally, the height of a tier is 1.3 cm on the
@@ -337,6 +377,9 @@ def display_annotations_timeline(annotations: list):
     height = ((len(tiers) * 1.3) + 1.8) * 42
     options = { "selectable": True, "zoomable": True, "stack": False, "height": height }
     timeline_items = util.get_timeline(annotations)
+    overview = st.session_state.video.filmstrip.overview(20)
+    if overview is not None:
+        st.image(overview)
     try:
         item = streamlit_timeline.st_timeline(timeline_items, groups=groups, options=options)
         if item:
@@ -345,7 +388,9 @@ def display_annotations_timeline(annotations: list):
         pass
 
 def display_annotations_table(annotations: list):
-    rows = [a.as_row() for a in annotations]
+    starts = timestamps([a.start for a in annotations], short=True)
+    ends = timestamps([a.end for a in annotations], short=True)
+    rows = [a.as_row(start, end) for a, start, end in zip(annotations, starts, ends)]
     st.table(pd.DataFrame(rows, columns=Annotation.columns()))
 
 def display_errors():
@@ -378,6 +423,13 @@ def display_remove_annotation_select():
 def action_clear_image_cache():
     st.session_state.cache.reset()
 
+def action_snap_to(offset: int, keys: list):
+    """Set the inputs for a timepoint to the offset."""
+    tp = TimePoint(milliseconds=offset)
+    values = [tp.hours, tp.minutes, tp.seconds, tp.milliseconds]
+    for key, value in zip(keys, values):
+        st.session_state[key] = value
+
 def action_change_timeframe():
     t1, t2 = st.session_state.opt_timeframe
     if st.session_state.annotation.timeframe is None:
@@ -389,28 +441,27 @@ def action_add_objects(object_type: str, objects: list):
     """Put the objects in the list in play, that is, move them from the 'available'
     bin to the 'inplay' bin. After this, they will be available as options."""
     st.session_state.pool.put_objects_in_play(object_type, objects)
-    with open(st.session_state.io['json'], 'a') as fh:
-        for obj in objects:
-            fh.write(json.dumps({"add-object": (object_type, obj)}) + '\n')
-            message = f'Added {obj} and removed it from the pool'
-            st.session_state.messages.append(message)
-            util.log(message)
+    st.session_state.store.append(
+        [{"add-object": (object_type, obj)} for obj in objects], wait=False)
+    for obj in objects:
+        message = f'Added {obj} and removed it from the pool'
+        st.session_state.messages.append(message)
+        util.log(message)
 
 def action_remove_objects(object_type: str, objects: list):
     """Remove the objects in the list from play, that is, move them from the 'inplay'
     bin to the 'available' bin. After this, they won't be available as options."""
     st.session_state.pool.remove_objects_from_play(object_type, objects)
-    with open(st.session_state.io['json'], 'a') as fh:
-        for obj in objects:
-            fh.write(json.dumps({"remove-object": (object_type, obj)}) + '\n')
-            message = f'Removed {obj} and returned it to the pool'
-            st.session_state.messages.append(message)
-            util.log(message)
+    st.session_state.store.append(
+        [{"remove-object": (object_type, obj)} for obj in objects], wait=False)
+    for obj in objects:
+        message = f'Removed {obj} and returned it to the pool'
+        st.session_state.messages.append(message)
+        util.log(message)
 
 def action_remove_annotation(annotation_id: str):
     if annotation_id is not None:
-        with open(st.session_state.io['json'], 'a') as fh:
-            fh.write(json.dumps({"remove-annotation": annotation_id}) + '\n')
+        st.session_state.store.append([{"remove-annotation": annotation_id}], wait=False)
         remove_annotation(annotation_id)
         message = f"Removed  annotation {annotation_id}"
         st.session_state.messages.append(message)
@@ -427,7 +478,6 @@ def action_save_ending_time(timepoint: 'TimePoint'):
     util.log(f'Saved ending time {timepoint}')
 
 def remove_annotation(annotation_id: str):
-    st.session_state.annotations = \
-        [a for a in st.session_state.annotations if a.identifier != annotation_id]
+    st.session_state.annotations.remove(annotation_id)
 
 'EOF'
\ No newline at end of file
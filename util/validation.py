@@ -0,0 +1,207 @@
+"""
+
+Validation of annotations against the predicates and properties in the task
+configuration.
+
+The specifications are compiled once into validators that have what the checks
+need ready to go, which are the specifications indexed on their type and for each
+item of an input the options that are allowed. The same validators are used when
+saving an annotation in the tool and for checking saved annotations:
+
+$ python -m util.validation data/VIDEO_FILE.json CONFIG_FILE
+$ python -m util.validation data CONFIG_FILE
+
+This prints the problems with the annotations in one annotations file or in all
+annotations files in the data directory.
+
+"""
+
+import os
+import sys
+import functools
+
+from config import default as config
+from util.store import open_store, replay, annotation_files
+
+
+class InputValidator:
+
+    """Validator for an argument or property. The inputs for the items of an
+    argument are combined into one value by util.process_arguments() before the
+    annotation is saved, so this checks the combined value. Items that are lists of
+    options are compiled into the set of options plus the object pools that add
+    options, other items are free text.
+
+    With one item the value has to be one of the options of the item, unless the
+    item is free text. With more than one item any value goes if one of the items is
+    free text, otherwise the value has to be an option of one of the items or the
+    relation-location form rel(loc) with rel from the first item and loc from the
+    second."""
+
+    def __init__(self, specification: dict):
+        self.name = specification['type']
+        self.optional = specification.get('optional', False)
+        self.items = []
+        for item in specification['items']:
+            if isinstance(item, list):
+                options = frozenset(o for o in item if not isinstance(o, tuple))
+                pools = tuple(o[1] for o in item if isinstance(o, tuple) and o[0] == 'pool')
+                self.items.append((options, pools))
+            else:
+                self.items.append(None)
+        self.free_text = None in self.items
+
+    def __str__(self):
+        return f'<{self.__class__.__name__} {self.name} items={len(self.items)}>'
+
+    def check(self, value, objects, kind: str) -> list:
+        """Return errors for the value. The objects argument is a function that
+        returns the objects of a type that can be used, or None if values from
+        object pools should not be checked."""
+        if value is None or value == '':
+            if self.optional:
+                return []
+            return [f'WARNING: required {kind} "{self.name}" is not specified']
+        if self.free_text or self.is_option(value, objects):
+            return []
+        return [f'WARNING: "{value}" is not a valid value for {kind} "{self.name}"']
+
+    def is_option(self, value, objects) -> bool:
+        value = value if isinstance(value, str) else str(value)
+        if any(self.in_item(item, value, objects) for item in self.items):
+            return True
+        if len(self.items) > 1 and isinstance(value, str) and value.endswith(')'):
+            relation, _, location = value[:-1].partition('(')
+            return (self.in_item(self.items[0], relation, objects)
+                    and self.in_item(self.items[1], location, objects))
+        return False
+
+    @staticmethod
+    def in_item(item: tuple, value, objects) -> bool:
+        options, pools = item
+        if value in options:
+            return True
+        return bool(pools) and (objects is None or any(value in objects(p) for p in pools))
+
+
+class PredicateValidator:
+
+    def __init__(self, predicate: str, specifications: list):
+        self.predicate = predicate
+        self.arguments = {spec['type']: InputValidator(spec) for spec in specifications}
+
+    def __str__(self):
+        return f'<{self.__class__.__name__} {self.predicate} arguments={len(self.arguments)}>'
+
+    def check(self, arguments: dict, objects) -> list:
+        errors = []
+        for name, value in arguments.items():
+            validator = self.arguments.get(name)
+            if validator is None:
+                errors.append(
+                    f'WARNING: "{name}" is not an argument of predicate "{self.predicate}"')
+            else:
+                errors.extend(validator.check(value, objects, 'argument'))
+        for name, validator in self.arguments.items():
+            if name not in arguments and not validator.optional:
+                errors.append(f'WARNING: required argument "{name}" is not specified')
+        return errors
+
+
+class TaskValidator:
+
+    """All validators for the task, with a validator for each predicate and for
+    each property. Use get_validator() to get the validator for the configuration,
+    which is compiled the first time it is asked for."""
+
+    def __init__(self, predicates: dict, properties: list):
+        self.predicates = {p: PredicateValidator(p, specs) for p, specs in predicates.items()}
+        self.properties = {spec['type']: InputValidator(spec) for spec in properties}
+
+    def __str__(self):
+        return (f'<{self.__class__.__name__} predicates={len(self.predicates)}'
+                f' properties={len(self.properties)}>')
+
+    def check(self, annotation: dict, objects=None) -> list:
+        """Return the errors for an annotation in the format used in the annotations
+        file. See InputValidator.check() for the objects argument."""
+        errors = []
+        if annotation.get('task') is None:
+            errors.append('WARNING: the task is not specified')
+        if annotation.get('tier') is None:
+            errors.append('WARNING: the tier is not specified')
+        # TODO: add check for out of bounds start or end
+        start, end = annotation.get('start'), annotation.get('end')
+        if start is None:
+            errors.append('WARNING: the start position is not specified')
+        if end is None:
+            errors.append('WARNING: the end position is not specified')
+        if start is not None and end is not None and start > end:
+            errors.append('WARNING: the start of the interval cannot be before the end')
+        predicate = annotation.get('predicate')
+        if predicate is None:
+            errors.append('WARNING: the predicate is not specified')
+        elif predicate in self.predicates:
+            errors.extend(
+                self.predicates[predicate].check(annotation.get('arguments', {}), objects))
+        elif self.predicates:
+            errors.append(f'WARNING: "{predicate}" is not a known predicate')
+        for name, value in annotation.get('properties', {}).items():
+            # There is something iffy here with the tier property which can be in
+            # the properties, but does not need to be in the defined properties
+            if name in self.properties:
+                errors.extend(self.properties[name].check(value, objects, 'property'))
+        return errors
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator() -> TaskValidator:
+    return TaskValidator(config.PREDICATES, config.PROPERTIES)
+
+
+def known_objects(records: list) -> dict:
+    """Return all objects of each type that are in the configuration or that show up
+    in the records. We do not know what was in play when an annotation was made, so
+    bulk validation allows all of them."""
+    objects = {t: set(objs) for t, objs in config.OBJECT_POOL.items()}
+    for record in records:
+        if 'snapshot' in record:
+            for obj_type, pool in record['snapshot']['pool'].items():
+                for objs in pool.values():
+                    objects.setdefault(obj_type, set()).update(objs)
+        for key in ('add-object', 'remove-object'):
+            if key in record:
+                obj_type, obj = record[key][:2]
+                objects.setdefault(obj_type, set()).add(obj)
+    return objects
+
+
+def validate_file(json_path: str) -> dict:
+    """Validate the annotations for an annotations file, returns a dictionary with
+    the errors for the annotations that have errors."""
+    validator = get_validator()
+    records, _ = open_store(json_path).read()
+    objects = known_objects(records)
+    problems = {}
+    for identifier, annotation in replay(records).items():
+        errors = validator.check(annotation, lambda t: objects.get(t, ()))
+        if errors:
+            problems[identifier] = errors
+    return problems
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1]
+    json_paths = annotation_files(path) if os.path.isdir(path) else [path]
+    total = 0
+    for json_path in json_paths:
+        for identifier, errors in validate_file(json_path).items():
+            total += 1
+            for error in errors:
+                print(f'{json_path} {identifier} {error}')
+    print(f'Found {total} annotations with errors in {len(json_paths)} files')
+    sys.exit(1 if total else 0)
+
+
+'EOF'
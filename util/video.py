@@ -1,24 +1,37 @@
 import os
+import sys
+import math
 import time
-import asyncio
+import queue
+import struct
 import datetime
 import functools
+import weakref
+import threading
+import contextlib
+import collections
+import subprocess
+import concurrent.futures
 
 import cv2
 import numpy as np
 import streamlit as st
 
-from util.cache import ImageCache
+from config import default as config
+from util.cache import ImageCache, MISSING
 import util
 
 
-@functools.total_ordering
 class TimePoint:
 
     """Utility class to deal with time points, where a time point refers to an offset
     in the video. It is flexible in that it allows any number of seconds, minutes and
-    hours upon initialization, as long as the values are all integers >= 0. It will
-    normalize itself to cap seconds and minutes at 59 though."""
+    hours upon initialization, as long as the values are all integers. Time points
+    are immutable and store the offset as one integer number of milliseconds, the
+    hours, minutes, seconds and milliseconds are derived from it when needed, where
+    seconds and minutes are capped at 59 and milliseconds at 999."""
+
+    __slots__ = ('_ms',)
 
     @classmethod
     def from_date(cls, d: datetime.datetime):
@@ -38,87 +51,125 @@ class TimePoint:
         """Takes a TimePoint and returns a new one which is the same except that the
         specified amount of millicesonds is added."""
         # TODO: not currently used and probably deprecated
-        total = timepoint.in_milliseconds() + int(milliseconds)
-        return cls(milliseconds=total)
+        return timepoint.adjust_milliseconds(milliseconds)
 
     def __init__(self, hours=0, minutes=0, seconds=0, milliseconds=0):
-        # if hours < 0 or minutes < 0 or seconds < 0 or milliseconds < 0:
-        #    raise ValueError('Values need to be >= 0')
-        # print('===', hours, minutes, seconds, milliseconds)
-        self.hours = hours
-        self.minutes = minutes
-        self.seconds = seconds
-        self.milliseconds = milliseconds
-        self.normalize()
+        ms = ((hours * 60 + minutes) * 60 + seconds) * 1000 + milliseconds
+        object.__setattr__(self, '_ms', int(ms))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{self.__class__.__name__}' object is immutable")
+
+    def __reduce__(self):
+        return self.__class__, (0, 0, 0, self._ms)
 
     def __str__(self):
         return f'<{self.__class__.__name__} {self.timestamp()}>'
 
+    def __hash__(self):
+        return hash(self._ms)
+
     def __eq__(self, other):
-        return self.in_milliseconds() == other.in_milliseconds()
+        if not isinstance(other, TimePoint):
+            return NotImplemented
+        return self._ms == other._ms
 
     def __lt__(self, other):
-        return self.in_milliseconds() < other.in_milliseconds()
+        return self._ms < other._ms
+
+    def __le__(self, other):
+        return self._ms <= other._ms
+
+    def __gt__(self, other):
+        return self._ms > other._ms
+
+    def __ge__(self, other):
+        return self._ms >= other._ms
 
     def copy(self):
-        return TimePoint(
-            hours=self.hours, minutes=self.minutes,
-            seconds=self.seconds, milliseconds=self.milliseconds)
+        # Time points are immutable so there is no need for a real copy
+        return self
+
+    def fields(self) -> tuple:
+        """Returns the hours, minutes, seconds and milliseconds. For negative time
+        points all four are negative (or zero)."""
+        sign = -1 if self._ms < 0 else 1
+        seconds, milliseconds = divmod(abs(self._ms), 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return sign * hours, sign * minutes, sign * seconds, sign * milliseconds
+
+    @property
+    def hours(self):
+        return self.fields()[0]
+
+    @property
+    def minutes(self):
+        return self.fields()[1]
+
+    @property
+    def seconds(self):
+        return self.fields()[2]
+
+    @property
+    def milliseconds(self):
+        return self.fields()[3]
 
     def hh(self):
         """Return number of hours as a string."""
-        return f'{self.hours:02d}'
+        return f'{abs(self.hours):02d}'
 
     def mm(self):
         """Return number of minutes as a string."""
-        return f'{self.minutes:02d}'
+        return f'{abs(self.minutes):02d}'
 
     def ss(self):
         """Return number of seconds as a string."""
-        return f'{self.seconds:02d}'
+        return f'{abs(self.seconds):02d}'
 
     def mmm(self):
-        return f'{self.milliseconds:03d}'
+        return f'{abs(self.milliseconds):03d}'
 
     def timestamp(self, short=False) -> str:
+        sign = '-' if self._ms < 0 else ''
         if short:
-            return f'{self.mm()}:{self.ss()}.{self.mmm()}'
+            return f'{sign}{self.mm()}:{self.ss()}.{self.mmm()}'
         else:
-            return f'{self.hh()}:{self.mm()}:{self.ss()}.{self.mmm()}'
-
-    def normalize(self):
-        """Normalize values so that millisseconds < 1000, and seconds and minutes
-        are < 60. Normalization leaves the hours alone"""
-        if self.milliseconds > 999:
-            seconds = int(self.milliseconds / 1000)
-            self.seconds += seconds
-            self.milliseconds = self.milliseconds - (seconds * 1000)
-        if self.seconds > 59:
-            minutes = int(self.seconds / 60)
-            self.minutes += minutes
-            self.seconds = self.seconds - (minutes * 60)
-        if self.minutes > 59:
-            hours = int(self.minutes / 60)
-            self.hours += hours
-            self.minutes = self.minutes - (hours * 60)
+            return f'{sign}{self.hh()}:{self.mm()}:{self.ss()}.{self.mmm()}'
 
     def in_seconds(self):
         return self.hours * 3600 + self.minutes * 60 + self.seconds
 
     def in_milliseconds(self):
-        return self.in_seconds() * 1000 + self.milliseconds
+        return self._ms
+
+    def adjust_seconds(self, seconds: int) -> 'TimePoint':
+        """Returns a new timepoint with the seconds added."""
+        return TimePoint(milliseconds=self._ms + seconds * 1000)
 
-    def adjust_seconds(self, seconds: int):
-        """Add seconds to the timepoint and normalize."""
-        # TODO: must also know how to deal with values going negative
-        self.seconds += seconds
-        self.normalize()
+    def adjust_milliseconds(self, milliseconds: int) -> 'TimePoint':
+        """Returns a new timepoint with the milliseconds added."""
+        return TimePoint(milliseconds=self._ms + milliseconds)
 
-    def adjust_milliseconds(self, milliseconds: int):
-        """Add seconds to the timepoint and normalize."""
-        # TODO: must also know how to deal with values going negative
-        self.milliseconds += milliseconds
-        self.normalize()
+
+def timestamps(offsets: list, short=False) -> list:
+    """Format a list of offsets in milliseconds in one go, giving the same strings
+    as TimePoint.timestamp() would. Offsets that are None are formatted as 'None'."""
+    if not offsets:
+        return []
+    missing = np.array([offset is None for offset in offsets], dtype=bool)
+    ms = np.array([0 if offset is None else offset for offset in offsets], dtype=np.int64)
+    signs = np.where(ms < 0, '-', '')
+    seconds, milliseconds = np.divmod(np.abs(ms), 1000)
+    minutes, seconds = np.divmod(seconds, 60)
+    hours, minutes = np.divmod(minutes, 60)
+    def pad(values: np.ndarray, width: int) -> np.ndarray:
+        return np.char.zfill(values.astype(str), width)
+    result = signs if short else np.char.add(np.char.add(signs, pad(hours, 2)), ':')
+    result = np.char.add(np.char.add(result, pad(minutes, 2)), ':')
+    result = np.char.add(np.char.add(result, pad(seconds, 2)), '.')
+    result = np.char.add(result, pad(milliseconds, 3))
+    return np.where(missing, 'None', result).tolist()
 
 
 class TimeFrame:
@@ -147,11 +198,11 @@ class TimeFrame:
 
     def adjust_start(self, milliseconds: int):
         """Adjust the start point, using milliseconds."""
-        self.start.adjust_milliseconds(milliseconds)
+        self.start = self.start.adjust_milliseconds(milliseconds)
 
     def adjust_end(self, milliseconds: int):
         """Adjust the end point, using milliseconds."""
-        self.end.adjust_milliseconds(milliseconds)
+        self.end = self.end.adjust_milliseconds(milliseconds)
 
     def frame_at(self, milliseconds: int):
         # TODO: did not feel the need to use FrameCollector, could be wrong
@@ -165,40 +216,715 @@ class TimeFrame:
         return collect_frames(video, range(0, n * step, step))
 
 
+class Sidecar:
+
+    """Base class for files with data derived from a video that are stored next to
+    the annotations file. The file is created the first time it is needed and it is
+    recreated when the video changes. Creating the file may take a while so it is
+    done in a background thread and the data are not used till they are ready.
+    Subclasses implement load() and build(), both of which should end up setting
+    the loaded attribute."""
+
+    def __init__(self, video_path: str, path: str = None):
+        self.video_path = video_path
+        self.path = path
+        self.loaded = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'<{self.__class__.__name__} {self.path} ready={self.loaded}>'
+
+    @property
+    def ready(self) -> bool:
+        """Returns True if the data are available. Loads the data from disk if they
+        are there and up-to-date and starts building them if they are not."""
+        if not self.loaded and self.thread is None and self.path is not None:
+            with self.lock:
+                if not self.loaded and self.thread is None:
+                    if self.is_fresh():
+                        self.load()
+                    else:
+                        self.thread = threading.Thread(target=self.build, daemon=True)
+                        self.thread.start()
+        return self.loaded
+
+    def is_fresh(self) -> bool:
+        return (os.path.isfile(self.path)
+                and os.path.getmtime(self.path) >= os.path.getmtime(self.video_path))
+
+    def tmp_path(self) -> str:
+        """Path to build the file at before it replaces the file at self.path."""
+        root, ext = os.path.splitext(self.path)
+        return f'{root}.tmp{ext}'
+
+    def load(self):
+        raise NotImplementedError()
+
+    def build(self):
+        raise NotImplementedError()
+
+
+class FrameIndex(Sidecar):
+
+    """Presentation timestamps and keyframe flags for all frames in a video. The
+    index is created with one scan over the video and saved as a NumPy file next
+    to the annotations file, after that it is loaded from that file. The scan only
+    reads the packets from the video and does not decode the frames, but it may
+    still take a while for long videos."""
+
+    dtype = np.dtype([('ms', '<f8'), ('key', '?')])
+
+    def __init__(self, video_path: str, index_path: str = None):
+        super().__init__(video_path, index_path)
+        self.frames = None
+
+    def __str__(self):
+        return f'<FrameIndex {self.path} frames={len(self)}>'
+
+    def __len__(self):
+        return 0 if self.frames is None else len(self.frames)
+
+    def load(self):
+        self.set_frames(np.load(self.path))
+
+    def build(self):
+        """Scan the video and save the index. The capture is opened in raw mode so
+        that grab() does not decode the frame."""
+        vidcap = cv2.VideoCapture(
+            self.video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+        rows = []
+        while vidcap.grab():
+            rows.append((vidcap.get(cv2.CAP_PROP_POS_MSEC),
+                         bool(vidcap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME))))
+        vidcap.release()
+        frames = np.array(rows, dtype=self.dtype)
+        # Lookups bisect on the timestamps, but packets with B-frames can come in
+        # a different order than they are shown
+        if np.any(np.diff(frames['ms']) < 0):
+            util.log(f'Frame timestamps of {self.video_path} are out of order, sorting them')
+            frames = np.sort(frames, order='ms')
+        if len(frames):
+            # The first frame is where we go when everything else fails
+            frames['key'][0] = True
+            np.save(self.tmp_path(), frames)
+            os.replace(self.tmp_path(), self.path)
+            self.set_frames(frames)
+
+    def set_frames(self, frames: np.ndarray):
+        self.timestamps = np.ascontiguousarray(frames['ms'])
+        self.keyframes = np.flatnonzero(frames['key'])
+        self.frames = frames
+        self.loaded = True
+
+    def end(self) -> float:
+        """Returns the timestamp of the last frame."""
+        return float(self.timestamps[-1])
+
+    def timestamp(self, frame_number: int) -> float:
+        return float(self.timestamps[frame_number])
+
+    def frame_number(self, offset: int) -> int:
+        """Returns the number of the frame nearest to the offset in milliseconds."""
+        i = int(np.searchsorted(self.timestamps, offset))
+        if i == len(self.timestamps):
+            return i - 1
+        if i > 0 and offset - self.timestamps[i - 1] <= self.timestamps[i] - offset:
+            return i - 1
+        return i
+
+    def gap(self, frame_number1: int, frame_number2: int) -> float:
+        """Returns the time in milliseconds from the first to the second frame."""
+        return self.timestamps[frame_number2] - self.timestamps[frame_number1]
+
+    def keyframe_before(self, frame_number: int) -> int:
+        """Returns the number of the last keyframe at or before the frame."""
+        i = int(np.searchsorted(self.keyframes, frame_number, side='right'))
+        return int(self.keyframes[max(i - 1, 0)])
+
+
+class Decoder:
+
+    """Wraps a cv2.VideoCapture and has the code to extract frames from it. A Video
+    has a pool of decoders on the same file so that frames can be extracted in
+    parallel. A decoder should only be used by one thread at a time."""
+
+    def __init__(self, video_path: str, index: FrameIndex):
+        self.vidcap = cv2.VideoCapture(video_path)
+        self.index = index
+
+    def release(self):
+        self.vidcap.release()
+
+    def extract_window(self, offsets: list) -> dict:
+        """Extract frames for a list of offsets in milliseconds, returning a
+        dictionary indexed on the offsets with the image or None if extraction
+        failed. Instead of seeking for each offset, this seeks once to the earliest
+        offset and then walks forward through the video, only retrieving the frames
+        that are needed. With a frame index we use frame numbers and keyframes,
+        otherwise we seek again if the gap to the next offset is larger than
+        config.MAX_DECODE_GAP."""
+        if self.index.ready:
+            end = self.index.end()
+            numbers = {offset: self.index.frame_number(offset)
+                       for offset in offsets if offset <= end}
+            images = self.extract_frames(numbers.values())
+            return {offset: images.get(numbers.get(offset)) for offset in offsets}
+        targets = sorted(set(offsets))
+        images = {offset: None for offset in targets}
+        # Like cv2 seeking we select the frame nearest to the offset, that is, an
+        # offset belongs to a frame if it is less than half a frame beyond it
+        half_frame = 500 / self.vidcap.get(cv2.CAP_PROP_FPS)
+        position = None
+        i = 0
+        while i < len(targets):
+            if position is None or targets[i] - position > config.MAX_DECODE_GAP:
+                self.vidcap.set(cv2.CAP_PROP_POS_MSEC, targets[i])
+            if not self.vidcap.grab():
+                break
+            position = self.vidcap.get(cv2.CAP_PROP_POS_MSEC)
+            if targets[i] >= position + half_frame:
+                continue
+            success, image = self.vidcap.retrieve()
+            while i < len(targets) and targets[i] < position + half_frame:
+                images[targets[i]] = image if success else None
+                i += 1
+        return images
+
+    def extract_frames(self, frame_numbers: list) -> dict:
+        """Extract frames given their frame numbers, this requires the frame index.
+        We only seek if that saves us from decoding more than config.MAX_DECODE_GAP
+        milliseconds of frames, that is, if the keyframe before the next frame we
+        need is that far ahead of the current position. And then we seek to that
+        keyframe and decode forward."""
+        targets = sorted(set(frame_numbers))
+        images = {n: None for n in targets}
+        current = None
+        sought = None
+        i = 0
+        while i < len(targets):
+            key = self.index.keyframe_before(targets[i])
+            if key != sought and (current is None or self.index.gap(current, key)
+                                  > config.MAX_DECODE_GAP):
+                self.vidcap.set(cv2.CAP_PROP_POS_MSEC, self.index.timestamp(key))
+                sought = key
+            if not self.vidcap.grab():
+                break
+            # Use the timestamp to find out where we are since seeking in cv2 is
+            # not always exact
+            current = self.index.frame_number(self.vidcap.get(cv2.CAP_PROP_POS_MSEC))
+            if current < targets[i]:
+                continue
+            success, image = self.vidcap.retrieve()
+            while i < len(targets) and targets[i] <= current:
+                images[targets[i]] = image if success else None
+                i += 1
+        return images
+
+
+class Proxy(Sidecar):
+
+    """A small version of the video where every frame is a keyframe, which makes
+    random access to frames much cheaper than with the source video. The proxy is
+    created by decoding the video once and writing scaled-down frames as Motion
+    JPEG. Proxy frames line up with frames in the source video, so the frame index
+    is needed to find the frame for an offset in milliseconds."""
+
+    def __init__(self, video_path: str, proxy_path: str = None):
+        super().__init__(video_path, proxy_path)
+        self.frame_count = 0
+
+    def load(self):
+        vidcap = cv2.VideoCapture(self.path)
+        self.frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        vidcap.release()
+        self.loaded = True
+
+    def build(self):
+        source = cv2.VideoCapture(self.video_path)
+        fps = source.get(cv2.CAP_PROP_FPS)
+        writer = None
+        while True:
+            success, image = source.read()
+            if not success:
+                break
+            if writer is None:
+                height = round(image.shape[0] * config.PROXY_WIDTH / image.shape[1])
+                size = (config.PROXY_WIDTH, height)
+                writer = cv2.VideoWriter(
+                    self.tmp_path(), cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+            writer.write(cv2.resize(image, size, interpolation=cv2.INTER_AREA))
+        source.release()
+        if writer is not None:
+            writer.release()
+            os.replace(self.tmp_path(), self.path)
+            self.load()
+
+
+class Filmstrip(Sidecar):
+
+    """Thumbnails for the whole video, one every config.FILMSTRIP_STEP milliseconds,
+    for quick previews that do not need a decoder. The filmstrip is created in a
+    background process which decodes the video once and writes the thumbnails to
+    a file with a small header followed by an array of RGB images with shape (n,
+    height, width, 3). That file is memory-mapped and looking up a thumbnail just
+    returns a slice of the array."""
+
+    # Magic string, step in milliseconds, number of frames, height and width
+    HEADER = struct.Struct('<8sIIII')
+    HEADER_SIZE = 64
+    MAGIC = b'FILMSTRP'
+
+    def __init__(self, video_path: str, path: str = None):
+        super().__init__(video_path, path)
+        self.step = config.FILMSTRIP_STEP
+        self.frames = None
+
+    def is_fresh(self) -> bool:
+        # The filmstrip is also stale if it was made with other settings
+        if not super().is_fresh():
+            return False
+        with open(self.path, 'rb') as fh:
+            magic, step, _count, _height, width = self.read_header(fh)
+        return (magic == self.MAGIC
+                and step == config.FILMSTRIP_STEP and width == config.FILMSTRIP_WIDTH)
+
+    @classmethod
+    def read_header(cls, fh) -> tuple:
+        header = fh.read(cls.HEADER.size)
+        if len(header) < cls.HEADER.size:
+            return None, 0, 0, 0, 0
+        return cls.HEADER.unpack(header)
+
+    def load(self):
+        with open(self.path, 'rb') as fh:
+            _magic, self.step, count, height, width = self.read_header(fh)
+        self.frames = np.memmap(self.path, dtype=np.uint8, mode='r',
+                                offset=self.HEADER_SIZE, shape=(count, height, width, 3))
+        self.loaded = True
+
+    def build(self):
+        # This does not use multiprocessing because Streamlit runs the app as the
+        # main module and a spawned process would run the app again. The arguments
+        # are taken off sys.argv before importing since the config reads them.
+        code = ('import sys; args = sys.argv[1:]; del sys.argv[1:]; '
+                'from util.video import build_filmstrip; build_filmstrip(*args)')
+        command = [sys.executable, '-c', code, self.video_path, self.tmp_path(),
+                   self.path, str(config.FILMSTRIP_STEP), str(config.FILMSTRIP_WIDTH)]
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(command, cwd=root, capture_output=True, text=True)
+        if result.returncode == 0:
+            self.load()
+        else:
+            util.error(f'Error creating filmstrip for {self.video_path}', result.stderr)
+
+    def thumbnail(self, offset: int) -> np.ndarray:
+        """Returns the thumbnail nearest to the offset in milliseconds, or None if
+        the filmstrip is not ready or if the offset is beyond the end of the video."""
+        if not self.ready:
+            return None
+        if offset < 0 or offset > len(self.frames) * self.step:
+            return None
+        return self.frames[min(round(offset / self.step), len(self.frames) - 1)]
+
+    def overview(self, n: int) -> np.ndarray:
+        """Returns n thumbnails evenly spread over the video glued together as one
+        image, or None if the filmstrip is not ready."""
+        if not self.ready or not len(self.frames):
+            return None
+        positions = np.linspace(0, len(self.frames) - 1, n).round().astype(int)
+        return np.hstack(self.frames[positions])
+
+
+def build_filmstrip(video_path: str, tmp_path: str, path: str, step: str, width: str):
+    """Create the filmstrip file for the video. This runs in its own process and
+    the arguments come from the command line. The filmstrip is written to a
+    temporary file which then replaces the file at path."""
+    step = int(step)
+    width = int(width)
+    vidcap = cv2.VideoCapture(video_path)
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frame_count = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
+    video_width = vidcap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    video_height = vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    height = round(video_height * width / video_width)
+    # The frame count is not always exact so we allow for one extra second and
+    # truncate the file when we are done
+    count = int((frame_count / fps + 1) * 1000 / step) + 1
+    header_size = Filmstrip.HEADER_SIZE
+    with open(tmp_path, 'wb') as fh:
+        fh.truncate(header_size + count * height * width * 3)
+    frames = np.memmap(tmp_path, dtype=np.uint8, mode='r+',
+                       offset=header_size, shape=(count, height, width, 3))
+    # Like cv2 seeking we select the frame nearest to the target offset
+    half_frame = 500 / fps
+    i = 0
+    while i < count and vidcap.grab():
+        timestamp = vidcap.get(cv2.CAP_PROP_POS_MSEC)
+        if timestamp < i * step - half_frame:
+            continue
+        success, image = vidcap.retrieve()
+        if not success:
+            break
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        while i < count and timestamp >= i * step - half_frame:
+            frames[i] = image
+            i += 1
+    vidcap.release()
+    frames.flush()
+    del frames
+    with open(tmp_path, 'r+b') as fh:
+        fh.write(Filmstrip.HEADER.pack(Filmstrip.MAGIC, step, i, height, width))
+        fh.truncate(header_size + i * height * width * 3)
+    os.replace(tmp_path, path)
+
+
+class MotionCurve(Sidecar):
+
+    """Motion energy for all frames in a video, where the motion energy of a frame
+    is the mean absolute difference with the frame before it, after both frames are
+    scaled down and turned into grayscale. The curve is computed with one sequential
+    decode of the video, frames are handled in batches so the differences for a
+    batch are computed by NumPy in one go, and it is saved as a float32 NumPy file
+    next to the annotations file. Transitions, where motion starts or stops, are
+    used to suggest start and end points of annotations."""
+
+    BATCH_SIZE = 64
+
+    def __init__(self, video_path: str, path: str = None, index: FrameIndex = None):
+        super().__init__(video_path, path)
+        self.index = index
+        self.energy = None
+        self.transitions = None
+
+    def load(self):
+        self.set_energy(np.load(self.path))
+
+    def build(self):
+        vidcap = cv2.VideoCapture(self.video_path)
+        width = config.MOTION_WIDTH
+        height = round(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT) * width
+                       / vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        batch = np.empty((self.BATCH_SIZE + 1, height, width), dtype=np.uint8)
+        results = []
+        previous = None
+        size = 0
+        while True:
+            success, image = vidcap.read()
+            if success:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                batch[size + 1] = cv2.resize(
+                    image, (width, height), interpolation=cv2.INTER_AREA)
+                size += 1
+            if size and (size == self.BATCH_SIZE or not success):
+                # The first row has the last frame of the previous batch, so the
+                # differences also cover the frames on the batch boundaries
+                batch[0] = batch[1] if previous is None else previous
+                frames = batch[:size + 1].astype(np.int16)
+                diffs = np.abs(np.diff(frames, axis=0)).mean(axis=(1, 2))
+                results.append(diffs.astype(np.float32))
+                previous = batch[size].copy()
+                size = 0
+            if not success:
+                break
+        vidcap.release()
+        if results:
+            energy = np.concatenate(results)
+            np.save(self.tmp_path(), energy)
+            os.replace(self.tmp_path(), self.path)
+            self.set_energy(energy)
+
+    # Transitions closer together than this many frames are merged
+    RADIUS = 5
+
+    def set_energy(self, energy: np.ndarray):
+        """Set the motion energy and find the transitions, which are the frames where
+        the smoothed motion energy changes fastest. A transition is a frame where
+        the change is well above average and largest within RADIUS frames."""
+        smoothed = np.convolve(energy, np.ones(5, dtype=np.float32) / 5, mode='same')
+        change = np.abs(np.gradient(smoothed)) if len(smoothed) > 1 else smoothed
+        padded = np.pad(change, self.RADIUS)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * self.RADIUS + 1)
+        peaks = (change == windows.max(axis=1)) & (change > change.mean() + change.std())
+        self.transitions = np.flatnonzero(peaks)
+        self.energy = energy
+        self.loaded = True
+
+    def snap_points(self, offset: int, window: int = config.MOTION_SNAP_WINDOW,
+                    n: int = config.MOTION_SNAP_POINTS) -> list:
+        """Returns offsets in milliseconds of the n transitions nearest to the offset
+        that are at most window milliseconds away from it, in order of time. This
+        needs the frame index and returns an empty list if it is not ready."""
+        if not self.ready or not self.index.ready:
+            return []
+        transitions = self.transitions[self.transitions < len(self.index)]
+        times = self.index.timestamps[transitions]
+        distances = np.abs(times - offset)
+        nearby = np.flatnonzero(distances <= window)
+        nearest = nearby[np.argsort(distances[nearby], kind='stable')[:n]]
+        return sorted(int(round(times[i])) for i in nearest)
+
+
+class ProxyDecoder:
+
+    """Wraps a cv2.VideoCapture on the proxy. Since all frames in the proxy are
+    keyframes we can seek to any frame without decoding other frames."""
+
+    def __init__(self, proxy_path: str):
+        self.vidcap = cv2.VideoCapture(proxy_path)
+
+    def release(self):
+        self.vidcap.release()
+
+    def extract_frames(self, frame_numbers: list) -> dict:
+        """Extract frames given their frame numbers, returning a dictionary indexed
+        on the frame numbers with the image or None if extraction failed."""
+        images = {}
+        position = None
+        for n in sorted(set(frame_numbers)):
+            if n != position:
+                self.vidcap.set(cv2.CAP_PROP_POS_FRAMES, n)
+            success, image = self.vidcap.read()
+            images[n] = image if success else None
+            position = n + 1
+        return images
+
+
+class DecoderPool:
+
+    """A pool of decoders on the same file, new decoders are created with the
+    factory when all decoders are in use and the pool is not full yet, otherwise
+    we wait for a decoder to come back to the pool."""
+
+    def __init__(self, factory, size: int = config.DECODER_POOL_SIZE):
+        self.factory = factory
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def decoder(self):
+        """Borrow a decoder from the pool."""
+        try:
+            decoder = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.count < self.size
+                if create:
+                    self.count += 1
+            decoder = self.factory() if create else self.idle.get()
+        try:
+            yield decoder
+        finally:
+            self.idle.put(decoder)
+
+    def close(self):
+        """Release all idle decoders, decoders that are in use are not affected and
+        new decoders are created when needed."""
+        while True:
+            try:
+                decoder = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            decoder.release()
+            with self.lock:
+                self.count -= 1
+
+
 class Video:
 
-    """Class to wrap a cv2.VideoCapture instance and add some goodies to it."""
+    """Class to wrap a cv2.VideoCapture instance and add some goodies to it. If an
+    index path is given then a FrameIndex is used for exact seeking, and if a disk
+    cache is given then thumbnails are shared with other sessions through it. If a
+    proxy path is given then a Proxy is created and used for thumbnails, and with
+    a filmstrip path we get a Filmstrip for previews of the whole video. With a
+    motion path a MotionCurve is used to suggest boundaries. Contact sheets for
+    annotations are in the contact_sheets attribute.
 
-    def __init__(self, video_path: str):
+    Frames are extracted by a pool of at most config.DECODER_POOL_SIZE decoders,
+    each with their own cv2.VideoCapture, and submit_thumbnails() uses a thread
+    pool to run them in parallel (cv2 releases the GIL while decoding). The video
+    also has the image cache for its frames. All of this is thread-safe, so one Video
+    can be shared by all sessions through the VideoRegistry."""
+
+    def __init__(self, video_path: str, index_path: str = None,
+                 proxy_path: str = None, filmstrip_path: str = None,
+                 motion_path: str = None, disk_cache=None):
         self.path = video_path
         self.filename = os.path.basename(video_path)
-        self.vidcap = cv2.VideoCapture(video_path)
+        self.mtime = os.path.getmtime(video_path)
+        vidcap = cv2.VideoCapture(video_path)
+        self.fps = vidcap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        vidcap.release()
+        self.index = FrameIndex(video_path, index_path)
+        self.proxy = Proxy(video_path, proxy_path)
+        self.filmstrip = Filmstrip(video_path, filmstrip_path)
+        self.motion = MotionCurve(video_path, motion_path, self.index)
+        self.disk_cache = disk_cache
+        self.cache = ImageCache()
+        self.contact_sheets = ContactSheets(self)
+        self.decoders = DecoderPool(lambda: Decoder(self.path, self.index))
+        self.proxy_decoders = DecoderPool(lambda: ProxyDecoder(self.proxy.path))
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.DECODER_POOL_SIZE, thread_name_prefix='decoder')
         self.start = datetime.time.min
         self.end = self.get_video_end()
-        self._length = self.end.hour * 3600 + self.end.minute * 60 + self.end.second
 
     def __str__(self):
         return f'<Video path={os.path.basename(self.path)} {len(self)}>'
 
     def __len__(self):
-        return self._length
+        end = self.get_video_end()
+        return end.hour * 3600 + end.minute * 60 + end.second
 
     def get_video_end(self) -> datetime.time:
         """Return the last reliable location in the video as a datetime.time object
-        (which means that videos cannot be longer than 24 hours)."""
-        fps = self.vidcap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(self.vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
-        seconds = frame_count / fps
-        last_reliable_second = int(seconds) - 1
-        tp = TimePoint(seconds=last_reliable_second)
-        return datetime.time(hour=tp.hours, minute=tp.minutes, second=tp.seconds)
+        (which means that videos cannot be longer than 24 hours). This is exact if
+        the frame index is available, otherwise it is estimated from the frame rate
+        and the frame count and we back off a second."""
+        if self.index.ready:
+            tp = TimePoint(milliseconds=int(self.index.end()))
+        else:
+            seconds = self.frame_count / self.fps
+            last_reliable_second = int(seconds) - 1
+            tp = TimePoint(seconds=last_reliable_second)
+        return datetime.time(hour=tp.hours, minute=tp.minutes, second=tp.seconds,
+                             microsecond=tp.milliseconds * 1000)
 
     def extract_frame(self, offset: int):
         """Extract a frame from the video at a particular offset in milliseconds,
         return the image or None if extraction failed."""
-        self.vidcap.set(cv2.CAP_PROP_POS_MSEC, offset)
-        success, image = self.vidcap.read()
-        return image if success else None
+        return self.extract_window([offset])[offset]
+
+    def extract_window(self, offsets: list, thumbnails=False) -> dict:
+        """Extract frames for a list of offsets in milliseconds with one decoder,
+        returning a dictionary indexed on the offsets. Returns encoded thumbnails
+        instead of images if thumbnails=True."""
+        with self.decoders.decoder() as decoder:
+            images = decoder.extract_window(offsets)
+        if thumbnails:
+            images = {offset: make_thumbnail(image) for offset, image in images.items()}
+        return images
+
+    def extract_thumbnails(self, offsets: list) -> dict:
+        """Get thumbnails for a list of offsets in milliseconds, returning a dictionary
+        indexed on the offsets. See submit_thumbnails() for where they come from."""
+        thumbnails = {}
+        for future in self.submit_thumbnails(offsets):
+            thumbnails.update(future.result())
+        return thumbnails
+
+    def submit_thumbnails(self, offsets: list, cancelled: threading.Event = None) -> list:
+        """Start getting thumbnails for a list of offsets in milliseconds, from the
+        disk cache if possible and otherwise by extracting them from the proxy or
+        the video, in which case they are added to the disk cache. Extraction is
+        split in regions that are handed to the decoders in parallel. Returns a list
+        of futures, each with a dictionary of thumbnails indexed on offsets. Regions
+        that were not started yet when the cancelled event is set are skipped and
+        their dictionaries are empty. The disk cache is indexed on frame numbers and
+        can only be used when we have the frame index."""
+        thumbnails = {}
+        missing = offsets
+        if self.disk_cache is not None and self.index.ready:
+            for offset in offsets:
+                thumbnail = self.disk_cache.get(self.disk_key(offset))
+                if thumbnail is not None:
+                    thumbnails[offset] = thumbnail
+            missing = [offset for offset in offsets if offset not in thumbnails]
+        cached = concurrent.futures.Future()
+        cached.set_result(thumbnails)
+        if self.uses_proxy():
+            # All proxy frames are keyframes so we can split anywhere
+            targets = sorted(set(missing))
+            size = max(math.ceil(len(targets) / config.DECODER_POOL_SIZE), 1)
+            regions = [targets[i:i + size] for i in range(0, len(targets), size)]
+        else:
+            regions = self.split_regions(missing)
+        return [cached] + [self.executor.submit(self.extract_region, region, cancelled)
+                           for region in regions]
+
+    def extract_region(self, offsets: list, cancelled: threading.Event = None) -> dict:
+        """Extract thumbnails for a region of the video, from the proxy if it can be
+        used and from the video itself if not, and add them to the disk cache."""
+        if cancelled is not None and cancelled.is_set():
+            return {}
+        if self.uses_proxy():
+            numbers = {offset: self.frame_number(offset) for offset in offsets}
+            with self.proxy_decoders.decoder() as decoder:
+                images = decoder.extract_frames(
+                    [n for n in numbers.values() if n is not None])
+            thumbnails = {offset: make_thumbnail(images.get(n))
+                          for offset, n in numbers.items()}
+        else:
+            thumbnails = self.extract_window(offsets, thumbnails=True)
+        if self.disk_cache is not None and self.index.ready:
+            for offset, thumbnail in thumbnails.items():
+                self.disk_cache.put(self.disk_key(offset), thumbnail)
+        return thumbnails
+
+    def uses_proxy(self) -> bool:
+        """The proxy can be used if it is ready and its frames line up with the
+        frames in the frame index."""
+        return (self.proxy.ready and self.index.ready
+                and self.proxy.frame_count == len(self.index))
+
+    def disk_key(self, offset: int) -> tuple:
+        frame_number = self.index.frame_number(offset)
+        return (os.path.abspath(self.path), self.mtime, frame_number,
+                config.DEFAULT_IMAGE_WIDTH)
+
+    def frame_number(self, offset: int):
+        """Map an offset in milliseconds to the number of the frame nearest to it.
+        Uses the frame index if it is ready and otherwise estimates the number from
+        the frame rate, which is exact for videos with a constant frame rate. Returns
+        None for offsets after the end of the video."""
+        if self.index.ready:
+            if offset > self.index.end():
+                return None
+            return self.index.frame_number(offset)
+        frame_number = max(round(offset * self.fps / 1000), 0)
+        return frame_number if frame_number < self.frame_count else None
+
+    def split_regions(self, offsets: list) -> list:
+        """Split the offsets into regions that can be decoded independently. A new
+        region starts where a decoder would seek anyway: where a keyframe lies
+        between two offsets if we have the frame index, or where the gap between
+        them is larger than config.MAX_DECODE_GAP if we do not. Neighbouring regions
+        are then merged so there are about as many regions as decoders."""
+        targets = sorted(set(offsets))
+        if not targets:
+            return []
+        regions = [[targets[0]]]
+        for previous, offset in zip(targets, targets[1:]):
+            if self.seeks_between(previous, offset):
+                regions.append([offset])
+            else:
+                regions[-1].append(offset)
+        size = math.ceil(len(targets) / config.DECODER_POOL_SIZE)
+        merged = [regions[0]]
+        for region in regions[1:]:
+            if len(merged[-1]) + len(region) <= size:
+                merged[-1].extend(region)
+            else:
+                merged.append(region)
+        return merged
+
+    def seeks_between(self, offset1: int, offset2: int) -> bool:
+        """Returns True if decoding from the first to the second offset would be
+        done with a seek rather than by decoding all frames in between."""
+        if self.index.ready:
+            n1 = self.index.frame_number(offset1)
+            n2 = self.index.frame_number(offset2)
+            return self.index.gap(n1, self.index.keyframe_before(n2)) > config.MAX_DECODE_GAP
+        return offset2 - offset1 > config.MAX_DECODE_GAP
+
+    def close(self):
+        """Release the file handles of all idle decoders."""
+        self.decoders.close()
+        self.proxy_decoders.close()
 
     def extract_frame_at_second(self, offset: int):
         return self.extract_frame(offset * 1000)
@@ -210,18 +936,53 @@ class Video:
         return self.extract_frame(timepoint.in_milliseconds())
 
 
+def make_thumbnail(image: np.ndarray, width: int = config.DEFAULT_IMAGE_WIDTH) -> bytes:
+    """Scale the image down to the width and encode it in config.THUMBNAIL_FORMAT,
+    returns None if there was no image or if encoding failed."""
+    if image is None:
+        return None
+    if image.shape[1] > width:
+        height = round(image.shape[0] * width / image.shape[1])
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return encode_image(image)
+
+
+def encode_image(image: np.ndarray) -> bytes:
+    """Encode the image in config.THUMBNAIL_FORMAT, returns None if encoding failed."""
+    if config.THUMBNAIL_FORMAT == '.webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, config.THUMBNAIL_QUALITY]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, config.THUMBNAIL_QUALITY]
+    success, buffer = cv2.imencode(config.THUMBNAIL_FORMAT, image, params)
+    return buffer.tobytes() if success else None
+
+
+# Stand-in for images that were not extracted before the deadline
+LATE = object()
+
+
 class Frame:
 
-    """Class to wrap the frame extracted with vidcap.read()."""
+    """Class to wrap the frame extracted with vidcap.read(). The image is stored as
+    an encoded thumbnail, which can be handed to st.image() as is. Images are cached
+    on the frame number, so offsets that map to the same frame share an image. A
+    frame that was not extracted before its deadline gets the nearest thumbnail
+    from the filmstrip, if there is one, as a stand-in."""
 
-    def __init__(self, vidcap, cache: ImageCache, offset: int):
+    def __init__(self, vidcap, cache: ImageCache, offset: int, image=MISSING):
         self.vidcap = vidcap
         self.timepoint = TimePoint(milliseconds=offset)
-        if offset in cache:
-            image = cache[offset]
-        else:
+        self.frame_number = vidcap.frame_number(offset)
+        self.late = image is LATE
+        if self.late:
+            image = vidcap.filmstrip.thumbnail(offset)
+        if image is MISSING and self.frame_number is None:
+            image = None
+        if image is MISSING:
+            image = cache.get(self.frame_number, MISSING)
+        if image is MISSING:
             image = self.get_frame(offset)
-            cache[offset] = image
+            cache[self.frame_number] = image
         self.image = image
         self.success = False if self.image is None else True
 
@@ -229,48 +990,302 @@ class Frame:
         timestamp = self.timepoint.timestamp()
         return f'<{self.__class__.__name__} t={timestamp} image={self.success}>'
 
-    def get_frame(self, offset: int) -> np.ndarray:
+    def get_frame(self, offset: int) -> bytes:
         util.debug(f'Extracting frame at {offset} from video')
-        return self.vidcap.extract_frame(offset)
+        return self.vidcap.extract_thumbnails([offset])[offset]
 
     def caption(self, short=True):
-        return self.timepoint.timestamp(short=short)
+        caption = self.timepoint.timestamp(short=short)
+        return f'{caption} (…)' if self.late else caption
 
 
 class FrameCollector:
 
-    """Class that wraps frame retrieval from the video in asynchronous calls."""
+    """Class that collects frames from the video. Offsets are first mapped to frame
+    numbers so that offsets that end up at the same frame share the cached image
+    and are only extracted once. Frames that are not in the cache are extracted in
+    parallel by the decoders of the video.
 
-    # TODO: may want to use an asyncio timeout. Some errors may make this code hang
-    # and just not return anything. See the following for some background:
-    # https://betterstack.com/community/guides/scaling-python/python-timeouts/
+    Some errors make cv2 hang, so there is an optional deadline in seconds. Frames
+    that are not there after the deadline are returned as late frames, they will
+    be added to the cache when they come in. The collector can be cancelled, after
+    which frames that were not started on yet are skipped."""
 
-    def __init__(self, vidcap, cache: ImageCache):
+    def __init__(self, vidcap, cache: ImageCache, deadline: float = None):
         self.vidcap = vidcap
         self.cache = cache
+        self.deadline = deadline
+        self.cancelled = threading.Event()
         self.frames = []
 
-    async def get_frames(self, timepoints: list, timing=False):
+    def cancel(self):
+        self.cancelled.set()
+
+    def get_frames(self, timepoints: list, timing=False):
         util.debug(f'FrameCollector.get_frames({str(timepoints)})')
         t0 = time.time()
         self.timepoints = timepoints
-        calls = (self.get_frame(tp) for tp in timepoints)
-        util.debug('    await asyncio.gather(*calls) STARTED')
-        results = await asyncio.gather(*calls)
-        util.debug('    await asyncio.gather(*calls) ENDED')
+        frame_numbers, images = self.fetch(timepoints)
+        results = [Frame(self.vidcap, self.cache, tp, images[frame_numbers.get(tp)])
+                   for tp in timepoints]
         if timing:
             print(f"Got {len(timepoints)} frames in {time.time() - t0} seconds")
         return results
 
-    async def get_frame(self, tp: int):
-        return Frame(self.vidcap, self.cache, tp)
+    def fetch(self, timepoints: list):
+        """Make sure the images for the timepoints are in the cache, returns the
+        frame numbers for the timepoints and the images for the frame numbers. This
+        does not touch the session state so it can run in a background thread."""
+        frame_numbers = {tp: self.vidcap.frame_number(tp) for tp in timepoints}
+        # Offsets after the end of the video do not have a frame
+        images = {None: None}
+        frame_numbers = {tp: n for tp, n in frame_numbers.items() if n is not None}
+        self.cache.register_offsets(frame_numbers)
+        # For each frame number the first offset that maps to it, this is the offset
+        # we use if we need to extract the frame
+        offsets = {}
+        for tp, n in frame_numbers.items():
+            offsets.setdefault(n, tp)
+        images.update({n: self.cache.get(n, MISSING) for n in offsets})
+        missing = [offsets[n] for n, image in images.items() if image is MISSING]
+        if missing:
+            futures = self.vidcap.submit_thumbnails(missing, self.cancelled)
+            for future in futures:
+                future.add_done_callback(functools.partial(self.store, frame_numbers))
+            concurrent.futures.wait(futures, timeout=self.deadline)
+            for future in futures:
+                if future.done() and future.exception() is None:
+                    for tp, image in future.result().items():
+                        images[frame_numbers[tp]] = image
+            for tp in missing:
+                if images[frame_numbers[tp]] is MISSING:
+                    images[frame_numbers[tp]] = LATE
+        return frame_numbers, images
+
+    def store(self, frame_numbers: dict, future: concurrent.futures.Future):
+        """Add the thumbnails from the future to the cache, this is called when the
+        future is done, which may be after the deadline."""
+        if future.exception() is not None:
+            util.error(f'Error extracting frames: {future.exception()}')
+            return
+        for tp, image in future.result().items():
+            self.cache[frame_numbers[tp]] = image
 
 
-def collect_frames(video, frame_offsets: list):
+class Prefetcher:
+
+    """Warms the image cache in a background thread. The windows to prefetch are
+    handed in with prefetch(), which cancels windows from an earlier call that were
+    not yet fetched. The thread is started when there is work and it stops when
+    there is none left."""
+
+    def __init__(self, video: Video, cache: ImageCache):
+        self.video = video
+        self.cache = cache
+        self.requested = []
+        self.pending = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'<Prefetcher pending={len(self.pending)}>'
+
+    def prefetch(self, windows: list):
+        """Prefetch the windows, where each window is a list of offsets."""
+        with self.lock:
+            if windows == self.requested:
+                return
+            self.requested = windows
+            self.pending = list(windows)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        collector = FrameCollector(self.video, self.cache)
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                window = self.pending.pop(0)
+            try:
+                collector.fetch(window)
+            except Exception as e:
+                util.error(f'Error prefetching {window}: {e}')
+
+
+def collect_frames(video, frame_offsets: list,
+                   deadline: float = config.FRAME_DEADLINE, batch: str = None):
+    """Collect frames for the offsets, waiting at most deadline seconds for frames
+    that need to be extracted. If a batch name is given then a collection with the
+    same name that was started earlier in this session is cancelled, so that when
+    the annotator moves a boundary we stop working on the old boundary."""
     # TODO: probably add this to the video class
-    fc = FrameCollector(video, st.session_state.cache)
-    frames = asyncio.run(fc.get_frames(frame_offsets))
-    return frames
+    fc = FrameCollector(video, st.session_state.cache, deadline=deadline)
+    if batch is not None:
+        previous = st.session_state.batches.get(batch)
+        if previous is not None:
+            previous.cancel()
+        st.session_state.batches[batch] = fc
+    return fc.get_frames(frame_offsets)
+
+
+class ContactSheets:
+
+    """Contact sheets for annotations, where a contact sheet is one image with some
+    frames from the annotation next to each other. Sheets are made in a background
+    thread for the annotations handed to schedule() and they are cached on the
+    identifier and the start and end of the annotation, so an annotation with a
+    changed timeframe gets a new sheet. The frames themselves come from the image
+    cache of the video. The keys of sheets that are waiting or being made are in
+    the queued set, so a sheet is never made twice at the same time."""
+
+    def __init__(self, video: Video):
+        self.video = video
+        self.sheets = ImageCache(config.CONTACT_SHEET_CACHE_SIZE * 1024 * 1024)
+        self.pending = collections.deque()
+        self.queued = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'<ContactSheets sheets={len(self.sheets)} pending={len(self.pending)}>'
+
+    @staticmethod
+    def key(annotation) -> tuple:
+        return annotation.identifier, annotation.start, annotation.end
+
+    def get(self, annotation) -> bytes:
+        """Return the contact sheet for the annotation. Returns None if none of the
+        frames could be extracted, or if the sheet is not there yet, in which case
+        it is made in the background and it shows up on a later rerun."""
+        sheet = self.sheets.get(self.key(annotation), MISSING)
+        if sheet is MISSING:
+            self.schedule([annotation])
+            return None
+        return sheet
+
+    def schedule(self, annotations: list):
+        """Make contact sheets for the annotations in the background."""
+        with self.lock:
+            for annotation in annotations:
+                key = self.key(annotation)
+                if key not in self.queued and key not in self.sheets:
+                    self.queued.add(key)
+                    self.pending.append(key)
+            if self.pending and self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                key = self.pending.popleft()
+            try:
+                self.make(key)
+            except Exception as e:
+                util.error(f'Error making contact sheet for {key}: {e}')
+            finally:
+                with self.lock:
+                    self.queued.discard(key)
+
+    def make(self, key: tuple) -> bytes:
+        _identifier, start, end = key
+        step = config.CONTACT_SHEET_STEP
+        offsets = list(range(start, end, step))[:config.CONTACT_SHEET_SIZE]
+        collector = FrameCollector(self.video, self.video.cache)
+        frame_numbers, images = collector.fetch(offsets)
+        tiles = {}
+        for offset in offsets:
+            thumbnail = images[frame_numbers.get(offset)]
+            if thumbnail is not None:
+                buffer = np.frombuffer(thumbnail, dtype=np.uint8)
+                tiles[offset] = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        sheet = None
+        if tiles:
+            # Frames that could not be extracted are left black
+            blank = np.zeros_like(next(iter(tiles.values())))
+            row = []
+            for offset in offsets:
+                tile = tiles.get(offset, blank).copy()
+                label = TimePoint(milliseconds=offset).timestamp(short=True)
+                cv2.putText(tile, label, (3, tile.shape[0] - 4),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), 1,
+                            cv2.LINE_AA)
+                row.append(tile)
+            sheet = encode_image(cv2.hconcat(row))
+        self.sheets[key] = sheet
+        return sheet
+
+
+class VideoRegistry:
+
+    """The videos that are open in this process, indexed on the absolute path of
+    the video. Sessions get a video with open() and all sessions on the same video
+    share the Video instance and with it the decoders and the image cache. Each
+    session holds a Lease, when the last lease on a video is garbage collected the
+    decoders of the video are released, but the video and its image cache are kept
+    for the next session. A video is opened anew if the file has changed, sessions
+    that still have the old video keep using it until their leases are gone. Leases
+    are counted for each Video instance so that the old video is closed when its
+    own last lease is gone."""
+
+    def __init__(self):
+        self.videos = {}
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'<VideoRegistry videos={len(self.videos)}>'
+
+    def open(self, video_path: str, index_path: str = None, proxy_path: str = None,
+             filmstrip_path: str = None, motion_path: str = None, disk_cache=None):
+        """Returns a Lease on the video at the path."""
+        key = os.path.abspath(video_path)
+        with self.lock:
+            video = self.videos.get(key)
+            if video is None or video.mtime != os.path.getmtime(video_path):
+                if video is not None and not self.leases.get(video):
+                    self.leases.pop(video, None)
+                video = Video(video_path, index_path, proxy_path=proxy_path,
+                              filmstrip_path=filmstrip_path, motion_path=motion_path,
+                              disk_cache=disk_cache)
+                self.videos[key] = video
+            self.leases[video] = self.leases.get(video, 0) + 1
+        return Lease(self, key, video)
+
+    def release(self, key: str, video: Video):
+        with self.lock:
+            self.leases[video] -= 1
+            if self.leases[video] == 0:
+                video.close()
+                if self.videos.get(key) is not video:
+                    # The video was replaced, nobody is going to use it again
+                    del self.leases[video]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {os.path.basename(key): self.leases.get(video, 0)
+                    for key, video in self.videos.items()}
+
+
+class Lease:
+
+    """A session's claim on a video in the registry, the claim is released when
+    the lease is garbage collected."""
+
+    def __init__(self, registry: VideoRegistry, key: str, video: Video):
+        self.video = video
+        weakref.finalize(self, registry.release, key, video)
+
+
+@st.cache_resource
+def get_video_registry():
+    return VideoRegistry()
 
 
 'EOF'